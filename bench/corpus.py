@@ -0,0 +1,82 @@
+# Synthetic corpora for the benchmarks
+# Generates MSBTs with thousands of labels, DARCs with thousands of entries or multi-MiB payloads, and IPS patches with many records
+# Everything is generated from a fixed seed, so results are comparable between runs
+# Usage: python3 bench/corpus.py <output dir>
+
+import pathlib
+import random
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from scripts.darc import Darc
+from scripts.ips import IpsPatch
+from scripts.msbt import Msbt
+
+SEED = 0x3D5
+WORDS = ['Flipnote', 'Gallery', 'World', 'download', 'upload', 'star', 'comment', 'channel', 'creator', 'frame', 'layer', 'pen', 'ink', 'save', 'the', 'a', 'to', 'your', 'été', 'うごくメモ帳']
+# number of label groups in the app's own MSBT files
+MSBT_NUM_GROUPS = 101
+
+def label_hash(label, num_groups):
+  # Standard MSBT label hash, used to pick which group a label goes in
+  value = 0
+  for char in label.encode('ascii'):
+    value = (value * 0x492 + char) & 0xFFFFFFFF
+  return value % num_groups
+
+def make_text(rnd, num_words):
+  return ' '.join(rnd.choice(WORDS) for i in range(num_words))
+
+def make_msbt(num_labels, seed=SEED):
+  rnd = random.Random(seed)
+  msbt = Msbt()
+  groups = [msbt.add_group() for i in range(MSBT_NUM_GROUPS)]
+  for i in range(num_labels):
+    label = 'Label_%06d' % i
+    groups[label_hash(label, MSBT_NUM_GROUPS)].add_entry(label, make_text(rnd, rnd.randint(1, 24)))
+  return msbt
+
+def make_darc(num_entries, entry_size=200, seed=SEED):
+  # Entries are filled with a repeating random pattern, so they're still somewhat compressible
+  rnd = random.Random(seed)
+  darc = Darc()
+  for i in range(num_entries):
+    pattern = bytes(rnd.getrandbits(8) for j in range(16))
+    darc.root.add_entry(name='Entry%06d.bin' % i, data=(pattern * (entry_size // 16 + 1))[:entry_size])
+  return darc
+
+def make_ips_target(size, seed=SEED):
+  rnd = random.Random(seed)
+  return bytes(rnd.getrandbits(8) for i in range(0x1000)) * (size // 0x1000)
+
+def make_ips(target, num_records, seed=SEED):
+  # Returns a patch with a mix of literal and RLE records spread across the target, and the patched result
+  rnd = random.Random(seed)
+  modified = bytearray(target)
+  patch = IpsPatch()
+  spacing = len(target) // num_records
+  for i in range(num_records):
+    offset = i * spacing + rnd.randrange(spacing // 2)
+    size = rnd.randint(1, min(spacing // 2, 0x200))
+    if rnd.random() < 0.25:
+      data = bytes([rnd.getrandbits(8)]) * size
+    else:
+      data = bytes(rnd.getrandbits(8) for j in range(size))
+    patch.add_record(offset, data)
+    modified[offset:offset + size] = data
+  return patch, bytes(modified)
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    exit('usage: corpus.py <output dir>')
+  output_path = pathlib.Path(sys.argv[1])
+  output_path.mkdir(parents=True, exist_ok=True)
+  make_msbt(5000).save(str(output_path / 'labels_5000.msbt'))
+  make_darc(4000).save(output_path / 'entries_4000.darc')
+  make_darc(8, entry_size=0x80000).save(output_path / 'payload_4mib.darc')
+  target = make_ips_target(0x400000)
+  (output_path / 'ips_target.bin').write_bytes(target)
+  patch, modified = make_ips(target, 5000)
+  patch.save(str(output_path / 'records_5000.ips'))
+  print('Saved corpus to %s' % output_path)
@@ -0,0 +1,29 @@
+# Benchmark for Darc.write
+# Times archive compilation for increasing numbers of entries, to check that it scales linearly
+# Usage: python3 bench/darc_write.py [max entries]
+
+import sys
+import time
+
+# corpus.py is in the same folder as this script
+from corpus import make_darc
+
+def time_write(darc, repeat=3):
+  best = None
+  for i in range(repeat):
+    start = time.perf_counter()
+    darc.write()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+if __name__ == '__main__':
+  max_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 64000
+  num_entries = 1000
+  print('%10s %12s %12s %14s' % ('entries', 'size (KiB)', 'time (ms)', 'us per entry'))
+  while num_entries <= max_entries:
+    darc = make_darc(num_entries)
+    elapsed = time_write(darc)
+    size = len(darc.write())
+    print('%10d %12d %12.2f %14.3f' % (num_entries, size // 1024, elapsed * 1000, elapsed * 1e6 / num_entries))
+    num_entries *= 2
@@ -0,0 +1,282 @@
+# Benchmark suite for the scripts/ codecs and the full build
+# Times read/write round-trips of Msbt, Darc, IpsPatch and BLZ over synthetic corpora, translation catalog queries, plus an end-to-end build.py run
+# Every benchmark also checks round-trip byte parity, and fails if the output changes
+# Usage: python3 bench/run.py [--output results.json] [--repeat N] [--quick] [--only NAME...]
+#        python3 bench/run.py compare <baseline.json> <results.json> [--threshold 0.1]
+
+import argparse
+import configparser
+import json
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_PATH = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_PATH))
+
+import scripts.blz as Blz
+from scripts.darc import Darc, is_darc
+from scripts.ips import IpsPatch
+from scripts.catalog import Catalog
+from scripts.msbt import Msbt
+from corpus import make_darc, make_ips, make_ips_target, make_msbt
+
+RESULTS_VERSION = 1
+
+class ParityError(Exception):
+  pass
+
+def check(condition, message):
+  if not condition:
+    raise ParityError(message)
+
+def time_call(func, repeat):
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - start)
+  return times
+
+def result(times, size=0):
+  # size is the number of bytes processed per call, used to work out throughput
+  best = min(times)
+  return {
+    'min': best,
+    'median': statistics.median(times),
+    'runs': len(times),
+    'bytes': size,
+    'mib_per_s': size / best / 0x100000 if size and best else 0,
+  }
+
+def bench_msbt(results, repeat, scale):
+  msbt = make_msbt(5000 // scale)
+  data = msbt.write()
+  # parity: parsing and writing again has to give the same bytes, for both byte orders and with string pooling
+  check(Msbt.from_bytes(data).write() == data, 'MSBT round-trip changed the output')
+  for little_endian in [True, False]:
+    for pool_strings in [False, True]:
+      other = msbt.write(little_endian=little_endian, pool_strings=pool_strings)
+      check(Msbt.from_bytes(other).write(little_endian=little_endian, pool_strings=pool_strings) == other, 'MSBT round-trip changed the output (little endian: %s, pooled: %s)' % (little_endian, pool_strings))
+  check([[(entry.label, entry.text) for entry in group.entries] for group in Msbt.from_bytes(data).groups] == [[(entry.label, entry.text) for entry in group.entries] for group in msbt.groups], 'MSBT round-trip changed the text')
+  results['msbt.write'] = result(time_call(lambda: msbt.write(), repeat), len(data))
+  results['msbt.write_pooled'] = result(time_call(lambda: msbt.write(pool_strings=True), repeat), len(data))
+  results['msbt.parse'] = result(time_call(lambda: Msbt.from_bytes(data), repeat), len(data))
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    json_path = pathlib.Path(tmp_dir) / 'bench.msbt.json'
+    msbt.dump_json(json_path)
+    check(Msbt.from_json(json_path).write() == data, 'MSBT JSON round-trip changed the output')
+    results['msbt.from_json'] = result(time_call(lambda: Msbt.from_json(json_path), repeat), json_path.stat().st_size)
+
+def bench_darc(results, repeat, scale):
+  for name, darc in [('entries', make_darc(4000 // scale)), ('payload', make_darc(8, entry_size=0x80000 // scale))]:
+    data = bytes(darc.write())
+    # parity: the archive has to come back out byte for byte, and the streamed save has to match write()
+    check(is_darc(data), 'DARC %s header filesize is wrong' % name)
+    check(Darc.from_bytes(data).write() == data, 'DARC %s round-trip changed the output' % name)
+    check(Darc.from_bytes(Darc.from_bytes(data).write(little_endian=False)).write() == data, 'DARC %s big endian round-trip changed the output' % name)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = pathlib.Path(tmp_dir) / 'bench.darc'
+      darc.save(path)
+      check(path.read_bytes() == data, 'DARC %s streamed save differs from write()' % name)
+      results['darc.save_%s' % name] = result(time_call(lambda: darc.save(path), repeat), len(data))
+      with Darc.open_mapped(str(path)) as mapped:
+        check(all(bytes(mapped.get(entry.name)) == bytes(entry.data) for entry in darc.root.entries), 'DARC %s mapped entries differ' % name)
+    results['darc.write_%s' % name] = result(time_call(lambda: darc.write(), repeat), len(data))
+    results['darc.parse_%s' % name] = result(time_call(lambda: Darc.from_bytes(data), repeat), len(data))
+
+def bench_ips(results, repeat, scale):
+  target = make_ips_target(0x400000 // scale)
+  patch, modified = make_ips(target, 5000 // scale)
+  data = patch.write()
+  # parity: parsing and writing again gives the same patch, optimizing doesn't change the result and diffing finds an equivalent patch
+  parsed = IpsPatch()
+  parsed.parse(data)
+  check(parsed.write() == data, 'IPS round-trip changed the output')
+  optimized = IpsPatch()
+  optimized.parse(data)
+  optimized.optimize()
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    target_path = pathlib.Path(tmp_dir) / 'target.bin'
+    out_path = pathlib.Path(tmp_dir) / 'out.bin'
+    target_path.write_bytes(target)
+    for label, candidate in [('parsed', parsed), ('optimized', optimized), ('diffed', IpsPatch.from_diff(target, modified))]:
+      candidate.apply(target_path, out_path)
+      check(out_path.read_bytes() == modified, 'IPS %s patch gives the wrong result' % label)
+    results['ips.apply'] = result(time_call(lambda: parsed.apply(target_path, out_path), repeat), len(target))
+  results['ips.write'] = result(time_call(lambda: patch.write(), repeat), len(data))
+  results['ips.parse'] = result(time_call(lambda: IpsPatch().parse(data), repeat), len(data))
+
+  def optimize():
+    copy = IpsPatch()
+    copy.parse(data)
+    copy.optimize()
+  results['ips.optimize'] = result(time_call(optimize, repeat), len(data))
+  results['ips.from_diff'] = result(time_call(lambda: IpsPatch.from_diff(target, modified), repeat), len(target))
+
+def bench_blz(results, repeat, scale):
+  data = bytes(make_darc(400 // scale).write())
+  compressed = Blz.compress(data)
+  check(Blz.decompress(compressed) == data, 'BLZ round-trip changed the data')
+  results['blz.compress'] = result(time_call(lambda: Blz.compress(data), repeat), len(data))
+  results['blz.decompress'] = result(time_call(lambda: Blz.decompress(compressed), repeat), len(data))
+
+def bench_catalog(results, repeat, scale):
+  # Indexes a few languages' worth of MSBT sources, with some strings that contain FTS5 syntax characters
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    root_path = pathlib.Path(tmp_dir)
+    for i, language in enumerate(['EU_English', 'EU_French', 'EU_German']):
+      archive_path = root_path / 'EUR' / 'romfs' / 'messageData' / language / 'SystemMessage.blz'
+      archive_path.mkdir(parents=True)
+      for j in range(20):
+        msbt = make_msbt(1000 // scale, seed=i * 100 + j)
+        msbt.groups[0].add_entry('Label_WiFi', 'Connect to the Internet via Wi-Fi')
+        msbt.groups[1].add_entry('Label_Quote', 'Don\'t turn the power off')
+        msbt.dump_json(str(archive_path / ('File%02d.msbt.json' % j)))
+    catalog = Catalog.Open(root_path / 'catalog.sqlite', root_path)
+    try:
+      results['catalog.index'] = result(time_call(lambda: catalog.update(), 1))
+      results['catalog.update'] = result(time_call(lambda: catalog.update(), repeat))
+      # parity: plain text searches have to work even when they look like FTS5 syntax
+      for query in ['Wi-Fi', 'don\'t', '"power']:
+        check(len(catalog.search(query, limit=1000)) == 60, 'Catalog search for %s found the wrong entries' % query)
+      check(len(catalog.search('Wi-Fi', 'EU_French', limit=1000)) == 20, 'Catalog search by language found the wrong entries')
+      results['catalog.search'] = result(time_call(lambda: catalog.search('the', limit=1000), repeat))
+      results['catalog.lookup'] = result(time_call(lambda: catalog.lookup('Label_00*'), repeat))
+    finally:
+      catalog.close()
+
+def copy_sources(dest_path):
+  # Copies everything build.py needs into a scratch folder, with placeholder certs if the real ones aren't there
+  for name in ['build.py', 'config.ini', 'scripts', 'EUR', 'USA', 'JPN', 'ALL']:
+    src_path = ROOT_PATH / name
+    if src_path.is_dir():
+      shutil.copytree(str(src_path), str(dest_path / name), ignore=shutil.ignore_patterns('__pycache__'))
+    elif src_path.exists():
+      shutil.copy(str(src_path), str(dest_path / name))
+  config = configparser.ConfigParser()
+  config.read(str(dest_path / 'config.ini'))
+  for path_key, size_key in [('CERT_A_PATH', 'CERT_A_SIZE_MAX'), ('CERT_B_PATH', 'CERT_B_SIZE_MAX')]:
+    cert_path = dest_path / config['SETUP'][path_key]
+    if not cert_path.exists():
+      src_path = ROOT_PATH / config['SETUP'][path_key]
+      cert_path.write_bytes(src_path.read_bytes() if src_path.exists() else bytes(int(config['SETUP'][size_key])))
+
+def check_build_output(luma_path):
+  # Every built archive has to survive a round-trip, and every MSBT in it has to be rewritten identically
+  num_archives = 0
+  for path in sorted(luma_path.rglob('*')):
+    if path.suffix not in ('.blz', '.arc'):
+      continue
+    data = path.read_bytes()
+    if path.suffix == '.blz':
+      data = Blz.decompress(data)
+    darc = Darc.from_bytes(data)
+    check(darc.write() == data, '%s round-trip changed the output' % path)
+    for entry in darc.root.entries:
+      if entry.name.endswith('.msbt'):
+        check(Msbt.from_bytes(entry.data).write() == bytes(entry.data), '%s/%s round-trip changed the output' % (path, entry.name))
+    num_archives += 1
+  check(num_archives > 0, 'The build didn\'t produce any archives')
+
+def bench_build(results, repeat, scale):
+  # Times a clean build, and a rebuild where the cache is already up to date
+  clean_times = []
+  cached_times = []
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    work_path = pathlib.Path(tmp_dir)
+    copy_sources(work_path)
+    for i in range(max(1, repeat // 2)):
+      for path in [work_path / 'luma', work_path / '.buildcache']:
+        if path.exists():
+          shutil.rmtree(str(path))
+      for times in [clean_times, cached_times]:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, 'build.py'], cwd=str(work_path), check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    check_build_output(work_path / 'luma')
+    size = sum(path.stat().st_size for path in (work_path / 'luma').rglob('*') if path.is_file())
+  results['build.clean'] = result(clean_times, size)
+  results['build.cached'] = result(cached_times, size)
+
+BENCHMARKS = [
+  ('msbt', bench_msbt),
+  ('darc', bench_darc),
+  ('ips', bench_ips),
+  ('blz', bench_blz),
+  ('catalog', bench_catalog),
+  ('build', bench_build),
+]
+
+def run(args):
+  results = {}
+  scale = 10 if args.quick else 1
+  for name, bench in BENCHMARKS:
+    if args.only and name not in args.only:
+      continue
+    print('Running %s...' % name, file=sys.stderr)
+    bench(results, args.repeat, scale)
+  output = {
+    'version': RESULTS_VERSION,
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'quick': args.quick,
+    'results': results,
+  }
+  print('%-28s %12s %12s %12s' % ('benchmark', 'min (ms)', 'median (ms)', 'MiB/s'))
+  for name, item in results.items():
+    print('%-28s %12.3f %12.3f %12.2f' % (name, item['min'] * 1000, item['median'] * 1000, item['mib_per_s']))
+  if args.output:
+    with open(args.output, 'w') as fp:
+      fp.write(json.dumps(output, indent=2, sort_keys=True))
+    print('Saved results to %s' % args.output, file=sys.stderr)
+
+def compare(args):
+  with open(args.baseline, 'r') as fp:
+    baseline = json.loads(fp.read())
+  with open(args.results, 'r') as fp:
+    current = json.loads(fp.read())
+  if baseline.get('quick') != current.get('quick'):
+    print('Warning: comparing a --quick run against a full run', file=sys.stderr)
+  regressions = []
+  print('%-28s %12s %12s %9s' % ('benchmark', 'base (ms)', 'new (ms)', 'change'))
+  for name, item in current['results'].items():
+    base = baseline['results'].get(name)
+    if base is None:
+      print('%-28s %12s %12.3f %9s' % (name, '-', item['min'] * 1000, 'new'))
+      continue
+    change = item['min'] / base['min'] - 1
+    flag = ''
+    if change > args.threshold:
+      flag = ' REGRESSION'
+      regressions.append(name)
+    print('%-28s %12.3f %12.3f %+8.1f%%%s' % (name, base['min'] * 1000, item['min'] * 1000, change * 100, flag))
+  if regressions:
+    exit('%d benchmarks regressed by more than %d%%: %s' % (len(regressions), args.threshold * 100, ', '.join(regressions)))
+
+def main():
+  if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+    parser = argparse.ArgumentParser(prog='run.py compare', description='Compare benchmark results against a baseline')
+    parser.add_argument('baseline')
+    parser.add_argument('results')
+    parser.add_argument('--threshold', type=float, default=0.1, help='flag benchmarks that are slower than this fraction, defaults to 0.1 (10%%)')
+    compare(parser.parse_args(sys.argv[2:]))
+    return
+  parser = argparse.ArgumentParser(description='Benchmark the DARC, MSBT, IPS and BLZ codecs, the translation catalog and the full build')
+  parser.add_argument('-o', '--output', help='save results as JSON')
+  parser.add_argument('--repeat', type=int, default=5, help='number of times to run each benchmark')
+  parser.add_argument('--quick', action='store_true', help='use corpora a tenth of the size')
+  parser.add_argument('--only', action='append', choices=[name for name, bench in BENCHMARKS], help='only run this benchmark group, can be repeated')
+  args = parser.parse_args()
+  try:
+    run(args)
+  except ParityError as error:
+    exit('Parity check failed: %s' % error)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,30 @@
+# Load test for server.py
+# Fires concurrent patch requests at a running server and reports request throughput and latency percentiles
+# Usage: python3 bench/server_load.py [url] [requests] [concurrency]
+
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+def fetch(url):
+  start = time.perf_counter()
+  with urllib.request.urlopen(url) as response:
+    size = len(response.read())
+  return time.perf_counter() - start, size
+
+def percentile(values, fraction):
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+if __name__ == '__main__':
+  url = sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:8080/patch.zip'
+  num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+  concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    results = list(executor.map(fetch, [url] * num_requests))
+  elapsed = time.perf_counter() - start
+  latencies = sorted(latency for latency, size in results)
+  print('%d requests in %.2f s, %.1f req/s, %d KiB per response' % (num_requests, elapsed, num_requests / elapsed, results[0][1] // 1024))
+  for label, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]:
+    print('%4s %8.2f ms' % (label, percentile(latencies, fraction) * 1000))
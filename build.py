@@ -5,54 +5,95 @@
 # JPN support and Python tooling by Jaames
 # github.com/jaames | jamesdaniel.dev
 
-from sys import argv
+import argparse
 import struct
 import configparser
+import os
 import pathlib
 import shutil
-import subprocess
+import time
+from collections import ChainMap
+from concurrent.futures import ProcessPoolExecutor
 
 import scripts.ips as Ips
+import scripts.blz as Blz
+import scripts.profiler as Profiler
+import scripts.darc
+import scripts.msbt
+from scripts.cache import BuildCache, compiler_fingerprint
 from scripts.darc import Darc
+from scripts.manifest import update_manifest
 from scripts.msbt import Msbt
+from scripts.package import PackageWriter, get_package_mode
+from scripts.pipeline import Pipeline
+from scripts.watch import ChangeWatcher
 
-BLZ_PATH = './blz'
+CACHE_PATH = './.buildcache'
+TENANTS_PATH = './tenants'
+REGIONS = ['EUR', 'USA', 'JPN']
+# Unused artifacts are kept for a week, so that switching back and forth between versions of a file stays fast
+STORE_MAX_AGE = 7 * 24 * 60 * 60
+# Source files are read by a few threads ahead of the compile stage, plain files bigger than this are streamed when their archive is written instead
+READ_THREADS = 4
+PREFETCH_MAX_SIZE = 0x100000
 
-# load config
+def load_config(path):
+  config = configparser.ConfigParser()
+  config.read(path)
+  # check config sections
+  sections = config.sections()
+  if 'SETUP' not in sections or any(region not in sections for region in REGIONS):
+    exit('Config section missing, please check the project readme')
+  return config
 
-config = configparser.ConfigParser()
-config.read('config.ini')
+def get_tenants(config):
+  # Extra server deployments are configured as [SETUP.name] sections
+  return [section[len('SETUP.'):] for section in config.sections() if section.startswith('SETUP.')]
 
-# check and load config data
+def get_tenant_setup_config(config, tenant):
+  # Tenant sections only need to override what differs from [SETUP]
+  section = 'SETUP.%s' % tenant
+  if section not in config:
+    exit('Config section %s missing' % section)
+  return ChainMap(config[section], config['SETUP'])
 
-sections = config.sections()
-if 'SETUP' not in sections or 'EUR' not in sections or 'USA' not in sections or 'JPN' not in sections:
-  exit('Config section missing, please check the project readme')
+def load_setup(setup_config):
+  setup = {
+    'CERT_A_SIZE_MAX': int(setup_config['CERT_A_SIZE_MAX']),
+    'CERT_B_SIZE_MAX': int(setup_config['CERT_B_SIZE_MAX']),
+    'GALLERY_URL_SIZE_MAX': int(setup_config['GALLERY_URL_SIZE_MAX']),
+    'GALLERY_URL': setup_config['GALLERY_URL'],
+  }
 
-CERT_A_SIZE_MAX = int(config['SETUP']['CERT_A_SIZE_MAX'])
-CERT_B_SIZE_MAX = int(config['SETUP']['CERT_B_SIZE_MAX'])
-GALLERY_URL_SIZE_MAX = int(config['SETUP']['GALLERY_URL_SIZE_MAX'])
+  with open(setup_config['CERT_A_PATH'], 'rb') as f:
+    setup['CERT_A'] = f.read()
 
-with open(config['SETUP']['CERT_A_PATH'], 'rb') as f:
-  cert_a_data = f.read()
-  cert_a_size = len(cert_a_data)
+  with open(setup_config['CERT_B_PATH'], 'rb') as f:
+    setup['CERT_B'] = f.read()
 
-with open(config['SETUP']['CERT_B_PATH'], 'rb') as f:
-  cert_b_data = f.read()
-  cert_b_size = len(cert_b_data)
+  if len(setup['CERT_A']) > setup['CERT_A_SIZE_MAX']:
+    exit('Maximum filesize for cert A is %d bytes' % setup['CERT_A_SIZE_MAX'])
 
-gallery_url = config['SETUP']['GALLERY_URL']
+  if len(setup['CERT_B']) > setup['CERT_B_SIZE_MAX']:
+    exit('Maximum filesize for cert B is %d bytes' % setup['CERT_B_SIZE_MAX'])
 
-if cert_a_size > CERT_A_SIZE_MAX:
-  exit('Maximum filesize for cert A is', CERT_B_SIZE_MAX, 'bytes')
+  if len(setup['GALLERY_URL']) > setup['GALLERY_URL_SIZE_MAX']:
+    exit('Gallery URL cannot exceed %d characters' % setup['GALLERY_URL_SIZE_MAX'])
 
-if cert_b_size > CERT_B_SIZE_MAX:
-  exit('Maximum filesize for cert B is', CERT_B_SIZE_MAX, 'bytes')
+  return setup
 
-if len(gallery_url) > GALLERY_URL_SIZE_MAX:
-  exit('Gallery URL cannot exceed', GALLERY_URL_SIZE_MAX, 'characters')
+def build_codebin(setup, region_config, output_path):
+  patch = make_codebin_patch(setup, region_config)
+  # Merge adjacent records and pick the smallest encoding for each run, then save to file
+  patch.optimize()
+  patch.save(output_path)
 
-def build_codebin(region_config, output_path):
+def make_codebin_patch(setup, region_config):
+  cert_a_data = setup['CERT_A']
+  cert_a_size = len(cert_a_data)
+  cert_b_data = setup['CERT_B']
+  cert_b_size = len(cert_b_data)
+  gallery_url = setup['GALLERY_URL']
   # Create new IPS patch file
   patch = Ips.IpsPatch()
   # Set cert sizes - these are both uint32
@@ -67,65 +108,484 @@ def build_codebin(region_config, output_path):
   patch.add_record(int(region_config['CERT_A_DATA']), cert_a_data)
   patch.add_record(int(region_config['CERT_B_DATA']), cert_b_data)
   # Null out the rest of the old cert data
-  patch.add_record(int(region_config['CERT_A_DATA']) + cert_a_size, bytes(CERT_A_SIZE_MAX - cert_a_size))
-  patch.add_record(int(region_config['CERT_B_DATA']) + cert_b_size, bytes(CERT_B_SIZE_MAX - cert_b_size))
+  patch.add_record(int(region_config['CERT_A_DATA']) + cert_a_size, bytes(setup['CERT_A_SIZE_MAX'] - cert_a_size))
+  patch.add_record(int(region_config['CERT_B_DATA']) + cert_b_size, bytes(setup['CERT_B_SIZE_MAX'] - cert_b_size))
   # add url
   patch.add_record(int(region_config['GALLERY_URL']), gallery_url.encode('ascii'))
   # null out rest of the url
-  patch.add_record(int(region_config['GALLERY_URL']) + len(gallery_url), bytes(GALLERY_URL_SIZE_MAX - len(gallery_url)))
-  # Save to file
-  patch.save(output_path)
+  patch.add_record(int(region_config['GALLERY_URL']) + len(gallery_url), bytes(setup['GALLERY_URL_SIZE_MAX'] - len(gallery_url)))
+  return patch
+
+class WarmArchive:
+  # Keeps an archive's compiled entries in memory for watch mode, so that an edit only recompiles the files that changed
+  # Compressed archives also keep their compressor state, so only the part of the archive up to the last change is recompressed
+  def __init__(self, src_path, compress, pool_strings=False, store=None):
+    self.src_path = src_path
+    self.compress = compress
+    self.pool_strings = pool_strings
+    self.store = store
+    # child path: (mtime, size, entry name, entry data)
+    self.entries = {}
+    self.compressor = Blz.BlzCompressor() if compress else None
+
+  def update(self):
+    # Returns the new archive data, or None if nothing has changed since the last update
+    children = sorted(self.src_path.iterdir())
+    changed = []
+    for child in children:
+      stat = child.stat()
+      entry = self.entries.get(child)
+      if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+        changed.append((child, stat))
+    # removed entries also count as a change
+    if not changed and len(children) == len(self.entries):
+      return None
+    entries = {child: self.entries.get(child) for child in children}
+    # Only the changed sources are compiled, the same way the build pipeline compiles them
+    sources = [(child, child.read_bytes()) for child, stat in changed]
+    for (child, stat), (name, data) in zip(changed, compile_sources(self.src_path, sources, self.store, self.pool_strings)):
+      entries[child] = (stat.st_mtime_ns, stat.st_size, name, data)
+    self.entries = entries
+    data = make_darc(entry[2:] for entry in entries.values()).write()
+    if self.compress:
+      data = self.compressor.compress(data)
+    return data
 
-def build_romfs_dir(src_path, output_path):
+def collect_romfs_dir(src_path, output_path, archives, files=None):
   # If the src is a file, copy it directly to the romfs output location
+  # or if a files dict is given, queue it there instead so that nothing is written to disk
   if not src_path.is_dir():
-    shutil.copy(str(src_path), str(output_path))
-  # If the src directory name ends with .blz or .arc, compile its contents into an DARC file
-  elif src_path.match('*.blz') or src_path.match('*.arc'): 
-    # Create a new DARC instance
-    darc = Darc()
-    # Loop through directory contents
-    for child in src_path.iterdir():
-      darc_entry = darc.root.add_entry()
-      # If the file ends with .msbt.json, compile this to an .msbt
-      if child.match('*.msbt.json'):
-        msbt = Msbt.from_json(child)
-        darc_entry.name = str(child.relative_to(src_path).with_suffix(''))
-        darc_entry.data = msbt.write()
-      # Else write the file as-is
-      else:
-        darc_entry.name = str(child.relative_to(src_path))
-        darc_entry.data = child.read_bytes()
-    darc.save(output_path)
-    # If the directory name ends with .blz we also need to compress the resulting DARC archive
-    if src_path.match('*.blz'):
-      subprocess.call([BLZ_PATH, '-en', str(output_path)], stdout=subprocess.DEVNULL)
+    if files is None:
+      shutil.copy(str(src_path), str(output_path))
+    else:
+      files[output_path] = src_path
+  # If the src directory name ends with .blz or .arc, queue its contents to be compiled into an DARC file
+  # Later sources for the same output path replace earlier ones
+  elif src_path.match('*.blz') or src_path.match('*.arc'):
+    archives[output_path] = (src_path, src_path.match('*.blz'))
   # Otherwise make a new directory in the romfs output location
   else:
-    output_path.mkdir(parents=True, exist_ok=True)
+    if files is None:
+      output_path.mkdir(parents=True, exist_ok=True)
     # Recuresively repeat the process on all of its children
-    for child in src_path.iterdir():
-      build_romfs_dir(child, output_path / child.name)
+    for child in sorted(src_path.iterdir()):
+      collect_romfs_dir(child, output_path / child.name, archives, files)
+
+class ArchiveJob:
+  # An archive on its way through the build pipeline
+  def __init__(self, store_key, src_path, compress):
+    self.store_key = store_key
+    self.src_path = src_path
+    self.compress = compress
+    # [(child path, contents or None if it's read later)]
+    self.sources = []
+    # [(entry name, data, or child path for entries that are read when the archive is written)]
+    self.entries = []
+    self.darc = None
+    self.data = None
+    self.size = 0
+    self.start = 0
 
-for region in ['EUR', 'USA', 'JPN']:
+def read_archive(job):
+  # Prefetches an archive's sources, apart from large plain files, which are left to be streamed when the archive is written
+  job.start = time.perf_counter()
+  for child in sorted(job.src_path.iterdir()):
+    if child.match('*.msbt.json') or child.stat().st_size <= PREFETCH_MAX_SIZE:
+      job.sources.append((child, child.read_bytes()))
+    else:
+      job.sources.append((child, None))
+  return job
 
-  region_config = config[region]
-  output_path = pathlib.Path('./luma/titles/%s' % region_config['TITLE_ID'])
+def compile_msbt_sources(sources, pool_strings=False):
+  # Compiles a list of .msbt.json file contents, so that a whole archive's worth can be sent to a worker process at once
+  result = []
+  for source in sources:
+    with Profiler.span('msbt.from_json'):
+      msbt = Msbt.from_json_data(source)
+    with Profiler.span('msbt.write') as span:
+      data = msbt.write(pool_strings=pool_strings)
+      span.set(bytes_out=len(data))
+    result.append(data)
+  return result
+
+def compile_sources(src_path, sources, store=None, pool_strings=False, executor=None):
+  # Turns an archive's [(child path, data)] sources into [(entry name, data)] entries, compiling .msbt.json sources to .msbt
+  # Plain files that weren't prefetched keep their path as data, so they can be streamed when the archive is written
+  # Many sources are identical across regions and languages, so each one is only compiled once
+  compiled = {}
+  missing = {}
+  with Profiler.span('store.get'):
+    for child, data in sources:
+      if child.match('*.msbt.json'):
+        key = data if store is None else store.key('msbt', b'pool' if pool_strings else b'', data)
+        compiled[child] = None if store is None else store.get(key)
+        if compiled[child] is None:
+          missing.setdefault(key, []).append(child)
+  if missing:
+    source_data = dict(sources)
+    missing_sources = [source_data[children[0]] for children in missing.values()]
+    if executor is None:
+      results = compile_msbt_sources(missing_sources, pool_strings)
+    else:
+      results, events = executor.submit(Profiler.call, Profiler.is_enabled(), compile_msbt_sources, missing_sources, pool_strings).result()
+      Profiler.merge(events)
+    for (key, children), data in zip(missing.items(), results):
+      if store is not None:
+        store.put(key, data)
+      for child in children:
+        compiled[child] = data
+  entries = []
+  for child, data in sources:
+    if child in compiled:
+      entries.append((str(child.relative_to(src_path).with_suffix('')), compiled[child]))
+    else:
+      entries.append((str(child.relative_to(src_path)), child if data is None else data))
+  return entries
+
+def compile_archive_sources(job, store=None, pool_strings=False, executor=None):
+  job.entries = compile_sources(job.src_path, job.sources, store, pool_strings, executor)
+  job.sources = []
+  return job
+
+def make_darc(entries):
+  darc = Darc()
+  for name, data in entries:
+    if isinstance(data, pathlib.Path):
+      darc.root.add_file_entry(name, data)
+    else:
+      darc.root.add_entry(name=name, data=data)
+  return darc
+
+def assemble_archive(job):
+  darc = make_darc(job.entries)
+  job.entries = []
+  # Uncompressed archives are streamed to disk by the writer, so large files never have to be fully loaded
+  if not job.compress:
+    job.darc = darc
+    return job
+  with Profiler.span('darc.write') as span:
+    job.data = darc.write()
+    span.set(bytes_out=len(job.data))
+  job.size = len(job.data)
+  return job
+
+def compress_data(data):
+  with Profiler.span('blz.compress', bytes_in=len(data)) as span:
+    data = Blz.compress(data)
+    span.set(bytes_out=len(data))
+  return data
+
+def compress_archive(job, executor=None):
+  if not job.compress:
+    return job
+  if executor is None:
+    job.data = compress_data(job.data)
+  else:
+    job.data, events = executor.submit(Profiler.call, Profiler.is_enabled(), compress_data, job.data).result()
+    Profiler.merge(events)
+  return job
+
+def write_archive(job, store):
+  if job.darc is not None:
+    with Profiler.span('darc.save') as span:
+      job.size = store.put_file(job.store_key, job.darc.save)
+      span.set(bytes_out=job.size)
+    size = job.size
+  else:
+    size = len(job.data)
+    with Profiler.span('store.put', bytes_out=size):
+      store.put(job.store_key, job.data)
+  # The archive's time covers its whole trip through the pipeline, including time spent waiting in queues
+  Profiler.event('archive', job.start, path=job.src_path.as_posix(), bytes_in=job.size, bytes_out=size)
+  job.darc = None
+  job.data = None
+  return job
+
+def compile_archive(src_path, compress, pool_strings=False):
+  # Runs a single archive through the same stages as the build pipeline, without the store, and returns its data
+  job = assemble_archive(compile_archive_sources(read_archive(ArchiveJob(None, src_path, compress)), None, pool_strings))
+  if job.darc is not None:
+    with Profiler.span('darc.write') as span:
+      job.data = job.darc.write()
+      span.set(bytes_out=len(job.data))
+    return job.data
+  return compress_archive(job).data
+
+def build_archive_pipeline(queue, store, jobs=1, pool_strings=False, queue_depth=4):
+  # Builds every queued {store key: (src path, compress)} archive into the store
+  # Each archive goes through read -> compile -> assemble -> compress -> write, with every stage working on a different archive at once
+  # The compile and compress stages are CPU bound, so with more than one job they hand their work to a pool of worker processes
+  executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and len(queue) > 1 else None
+  try:
+    # The workers are forked on the first submit, which has to happen before the stage threads exist, so no thread holds a lock while forking
+    if executor is not None:
+      executor.submit(int).result()
+    pipeline = Pipeline(queue_depth)
+    pipeline.add_stage('read', read_archive, READ_THREADS)
+    pipeline.add_stage('compile', lambda job: compile_archive_sources(job, store, pool_strings, executor), jobs)
+    pipeline.add_stage('assemble', assemble_archive)
+    pipeline.add_stage('compress', lambda job: compress_archive(job, executor), jobs)
+    pipeline.add_stage('write', lambda job: write_archive(job, store))
+    pipeline.run(ArchiveJob(store_key, src_path, compress) for store_key, (src_path, compress) in queue.items())
+  finally:
+    if executor is not None:
+      executor.shutdown()
+  if Profiler.is_enabled():
+    print(pipeline.format_stats())
+
+def build_romfs_archives(archives, cache, jobs=1, pool_strings=False, queue_depth=4):
+  store = cache.store
+  # Skip any archive whose inputs haven't changed since the last build
+  stale = []
+  queue = {}
+  with Profiler.span('cache.check'):
+    for output_path, (src_path, compress) in archives.items():
+      key = cache.archive_key(src_path, endian='<', compress=compress, pool_strings=pool_strings)
+      if not cache.is_fresh(output_path, key):
+        # Archives with identical inputs only need to be compiled once, and nothing is compiled if the store already has it
+        store_key = store.key('darc', key)
+        stale.append((output_path, key, store_key))
+        if store_key not in queue and not store.has(store_key):
+          queue[store_key] = (src_path, compress)
+  # Every archive is independent, so they can be built in any order
+  # Results are always merged back into the cache in queue order to keep the manifest deterministic
+  if queue:
+    build_archive_pipeline(queue, store, jobs, pool_strings, queue_depth)
+  with Profiler.span('store.link'):
+    for output_path, key, store_key in stale:
+      store.link(store_key, output_path)
+      cache.update(output_path, key)
+
+def link_romfs_dir(src_path, output_path):
+  # Hardlinks every file in an already built romfs tree into another output tree, so they share the same data on disk
+  # Files are copied instead if hardlinks aren't supported
   output_path.mkdir(parents=True, exist_ok=True)
-  
-  # Generate code.bin patches
-  build_codebin(region_config, output_path / 'code.ips')
+  for child in sorted(src_path.iterdir()):
+    child_output_path = output_path / child.name
+    if child.is_dir():
+      link_romfs_dir(child, child_output_path)
+      continue
+    if child_output_path.exists():
+      if os.path.samefile(str(child), str(child_output_path)):
+        continue
+      child_output_path.unlink()
+    try:
+      os.link(str(child), str(child_output_path))
+    except OSError:
+      shutil.copy2(str(child), str(child_output_path))
 
-  # Create regional romfs files
+def collect_region_romfs(region, output_path, archives, files=None):
+  # Collect regional romfs files
   romfs_src_path = pathlib.Path('./%s/romfs' % region)
-  romfs_output_path = output_path / 'romfs/'
   if romfs_src_path.exists():
-    build_romfs_dir(romfs_src_path, romfs_output_path)
+    collect_romfs_dir(romfs_src_path, output_path, archives, files)
 
-  # Add global romfs files
+  # Collect global romfs files
   romfs_src_path = pathlib.Path('./ALL/romfs')
-  romfs_output_path = output_path / 'romfs/'
-  if romfs_src_path.exists(): 
-    build_romfs_dir(romfs_src_path, romfs_output_path)
+  if romfs_src_path.exists():
+    collect_romfs_dir(romfs_src_path, output_path, archives, files)
+
+def open_cache():
+  # The cache is invalidated whenever the compilers themselves change, including the archive stages in this file
+  return BuildCache.Open(CACHE_PATH, compiler_fingerprint([__file__, scripts.darc.__file__, scripts.msbt.__file__, Blz.__file__]))
+
+def build_romfs(config, cache, jobs=1, pool_strings=False, queue_depth=4):
+  # Builds every region's romfs files into luma/titles/<TITLE_ID>/romfs
+  archives = {}
+  for region in REGIONS:
+    output_path = pathlib.Path('./luma/titles/%s/romfs' % config[region]['TITLE_ID'])
+    collect_region_romfs(region, output_path, archives)
+  # Compile every region's archives in one go so that they can share the worker pool
+  build_romfs_archives(archives, cache, jobs, pool_strings, queue_depth)
+  with Profiler.span('cache.save'):
+    cache.save()
+    # Clear out anything in the artifact store that isn't linked to an output and hasn't been used for a while
+    cache.store.prune(time.time() - STORE_MAX_AGE)
+
+def compile_romfs(config, cache, jobs=1, pool_strings=False, queue_depth=4):
+  # Like build_romfs, but yields (package path, data, compressed) for every romfs file instead of writing them to disk
+  # Archives are still built through the pipeline into the artifact store, so anything already built is reused
+  archives = {}
+  files = {}
+  for region in REGIONS:
+    output_path = pathlib.PurePosixPath('luma/titles/%s/romfs' % config[region]['TITLE_ID'])
+    collect_region_romfs(region, output_path, archives, files)
+  for output_path, src_path in sorted(files.items()):
+    yield str(output_path), src_path.read_bytes(), False
+  store = cache.store
+  store_keys = []
+  queue = {}
+  with Profiler.span('cache.check'):
+    for output_path, (src_path, compress) in sorted(archives.items()):
+      store_key = store.key('darc', cache.archive_key(src_path, endian='<', compress=compress, pool_strings=pool_strings))
+      store_keys.append((output_path, store_key, compress))
+      if store_key not in queue and not store.has(store_key):
+        queue[store_key] = (src_path, compress)
+  if queue:
+    build_archive_pipeline(queue, store, jobs, pool_strings, queue_depth)
+  # Archives are yielded in path order, so the package layout doesn't depend on which one was built first
+  for output_path, store_key, compress in store_keys:
+    yield str(output_path), store.get(store_key), compress
+
+def watch_romfs(config, cache, pool_strings=False, tenants=None):
+  # Rebuilds romfs files whenever their sources change, until interrupted
+  # The first pass only primes the in-memory state for archives that are already up to date
+  tenants = tenants or []
+  store = cache.store
+  warm = {}
+  first = True
+  watcher = ChangeWatcher([pathlib.Path('./%s/romfs' % region) for region in REGIONS + ['ALL']])
+  print('Watching for changes, press Ctrl+C to stop')
+  try:
+    while True:
+      changed = set() if first else watcher.wait()
+      start = time.perf_counter()
+      archives = {}
+      files = {}
+      for region in REGIONS:
+        output_path = pathlib.Path('./luma/titles/%s/romfs' % config[region]['TITLE_ID'])
+        collect_region_romfs(region, output_path, archives, files)
+      # Plain files are copied again if they changed
+      for output_path, src_path in files.items():
+        if str(src_path) in changed:
+          output_path.parent.mkdir(parents=True, exist_ok=True)
+          shutil.copy(str(src_path), str(output_path))
+          print('Copied %s' % output_path)
+      for output_path, (src_path, compress) in archives.items():
+        archive = warm.get(output_path)
+        if archive is None or archive.src_path != src_path or archive.compress != compress:
+          archive = warm[output_path] = WarmArchive(src_path, compress, pool_strings, store)
+        data = archive.update()
+        if data is None:
+          continue
+        key = cache.archive_key(src_path, endian='<', compress=compress, pool_strings=pool_strings)
+        if first and cache.is_fresh(output_path, key):
+          continue
+        # Outputs are hardlinked to the artifact store, so they're replaced rather than written to in place
+        store_key = store.key('darc', key)
+        store.put(store_key, data)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        store.link(store_key, output_path)
+        cache.update(output_path, key)
+        for tenant in tenants:
+          tenant_output_path = pathlib.Path(TENANTS_PATH) / tenant / output_path
+          if tenant_output_path.parent.exists():
+            store.link(store_key, tenant_output_path)
+        print('Rebuilt %s' % output_path)
+      cache.save()
+      if not first:
+        update_manifests(tenants)
+        print('Done in %d ms' % ((time.perf_counter() - start) * 1000))
+      first = False
+  except KeyboardInterrupt:
+    pass
+  finally:
+    watcher.close()
+
+def update_manifests(tenants=None):
+  # deploy.py compares these with the manifest on the SD card to work out what needs copying
+  tenants = tenants or []
+  with Profiler.span('manifest'):
+    update_manifest(pathlib.Path('./luma'))
+    for tenant in tenants:
+      update_manifest(pathlib.Path(TENANTS_PATH) / tenant / 'luma')
+
+def package_build(config, package_path, setup, tenant_setups, cache, jobs=1, pool_strings=False, level=6, queue_depth=4):
+  # Writes everything straight into a package file, and one for each tenant in tenants/<name>/
+  package_path = pathlib.Path(package_path)
+  packages = [(setup, PackageWriter.Open(package_path, level))]
+  try:
+    for tenant, tenant_setup in tenant_setups:
+      tenant_package_path = pathlib.Path(TENANTS_PATH) / tenant / package_path.name
+      tenant_package_path.parent.mkdir(parents=True, exist_ok=True)
+      packages.append((tenant_setup, PackageWriter.Open(tenant_package_path, level)))
+    with Profiler.span('codebin'):
+      for package_setup, package in packages:
+        for region in REGIONS:
+          region_config = config[region]
+          patch = make_codebin_patch(package_setup, region_config).optimize()
+          package.add('luma/titles/%s/code.ips' % region_config['TITLE_ID'], patch.write())
+    # The romfs files are the same for every tenant, so each one only needs to be compiled once
+    for path, data, compressed in compile_romfs(config, cache, jobs, pool_strings, queue_depth):
+      with Profiler.span('package.add', bytes_in=len(data)):
+        for package_setup, package in packages:
+          package.add(path, data, compressed)
+  except BaseException:
+    for package_setup, package in packages:
+      package.abort()
+    raise
+  for package_setup, package in packages:
+    package.close()
+
+def save_profile(trace_path):
+  if not Profiler.is_enabled():
+    return
+  print(Profiler.current.format_summary())
+  Profiler.current.save_trace(trace_path)
+  print('Saved trace to %s' % trace_path)
+
+def main():
+  parser = argparse.ArgumentParser(description='Generate luma patches for Flipnote Studio 3D')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='number of archives to build in parallel, 0 uses every core')
+  parser.add_argument('--pool-strings', action='store_true', help='share one MSBT string between labels with identical text')
+  parser.add_argument('--matrix', action='store_true', help='also build patches for every [SETUP.name] section in config.ini')
+  parser.add_argument('--tenant', action='append', default=[], help='also build patches for the [SETUP.TENANT] section, can be repeated')
+  parser.add_argument('-o', '--output', help='write everything into a .zip, .tar, .tar.gz or .tar.xz package instead of the luma folder')
+  parser.add_argument('--watch', action='store_true', help='keep running and rebuild romfs files whenever their sources change')
+  parser.add_argument('--queue-depth', type=int, default=4, help='number of archives that can wait between each build stage')
+  parser.add_argument('--compression-level', type=int, default=6, help='compression level for --output, from 0 to 9')
+  parser.add_argument('--profile', nargs='?', const='build-trace.json', metavar='TRACE', help='print a timing summary, and save a Chrome trace to TRACE (build-trace.json by default)')
+  args = parser.parse_args()
+  jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+  if args.profile is not None:
+    Profiler.enable()
+
+  if args.output is not None and get_package_mode(args.output) is None:
+    exit('Unsupported package format %s, use .zip, .tar, .tar.gz or .tar.xz' % args.output)
+  if args.queue_depth < 1:
+    exit('Queue depth must be at least 1')
+  if not 0 <= args.compression_level <= 9:
+    exit('Compression level must be between 0 and 9')
+
+  config = load_config('config.ini')
+  setup = load_setup(config['SETUP'])
+  tenants = get_tenants(config) if args.matrix else args.tenant
+  # Load every tenant's setup up front so that config errors show up before anything is built
+  tenant_setups = [(tenant, load_setup(get_tenant_setup_config(config, tenant))) for tenant in tenants]
+
+  if args.output is not None:
+    with Profiler.span('package'):
+      package_build(config, args.output, setup, tenant_setups, open_cache(), jobs, args.pool_strings, args.compression_level, args.queue_depth)
+    save_profile(args.profile)
+    return
+
+  with Profiler.span('codebin'):
+    for region in REGIONS:
+      region_config = config[region]
+      output_path = pathlib.Path('./luma/titles/%s' % region_config['TITLE_ID'])
+      output_path.mkdir(parents=True, exist_ok=True)
+      # Generate code.bin patches
+      build_codebin(setup, region_config, output_path / 'code.ips')
+
+  with Profiler.span('romfs'):
+    build_romfs(config, open_cache(), jobs, args.pool_strings, args.queue_depth)
+
+  # Tenants only differ by their code.bin patches, so they all share the romfs files built above
+  with Profiler.span('tenants'):
+    for tenant, tenant_setup in tenant_setups:
+      for region in REGIONS:
+        region_config = config[region]
+        src_path = pathlib.Path('./luma/titles/%s' % region_config['TITLE_ID'])
+        output_path = pathlib.Path(TENANTS_PATH) / tenant / ('luma/titles/%s' % region_config['TITLE_ID'])
+        output_path.mkdir(parents=True, exist_ok=True)
+        build_codebin(tenant_setup, region_config, output_path / 'code.ips')
+        if (src_path / 'romfs').exists():
+          link_romfs_dir(src_path / 'romfs', output_path / 'romfs')
 
+  update_manifests(tenants)
+  save_profile(args.profile)
+  if args.watch:
+    watch_romfs(config, open_cache(), args.pool_strings, tenants)
 
+if __name__ == '__main__':
+  main()
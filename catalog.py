@@ -0,0 +1,78 @@
+# Translation catalog tool
+# Looks up labels and strings across every region and language without opening each .msbt.json source
+# The catalog is kept in .buildcache/catalog.sqlite and is brought up to date with the sources before every query, which only re-reads changed files
+# Usage: catalog.py update
+#        catalog.py languages
+#        catalog.py lookup <label> [--language EU_French] [--region EUR]
+#        catalog.py search <query> [--language EU_French] [--region EUR] [--limit N] [--fts]
+#        catalog.py diff <language> <other language> [--same]
+# Languages can also be given with their region, e.g. EUR/EU_English, and labels can use * and ? wildcards
+
+import argparse
+import time
+
+from scripts.catalog import Catalog, diff_texts
+
+CATALOG_PATH = './.buildcache/catalog.sqlite'
+
+def print_entries(rows):
+  for region, language, archive, name, group_index, label, text in rows:
+    print('%s/%s/%s/%s [%d] %s' % (region, language, archive, name, group_index, label))
+    print('  %s' % text.replace('\n', '\n  '))
+  print('%d entries' % len(rows))
+
+def print_keys(title, keys, texts):
+  print('%s (%d)' % (title, len(keys)))
+  for archive, name, label in keys:
+    print('  %s/%s %s: %s' % (archive, name, label, texts[(archive, name, label)].replace('\n', '\\n')))
+
+def main():
+  parser = argparse.ArgumentParser(description='Query an index of every translation string in the romfs sources')
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  subparsers.add_parser('update', help='bring the catalog up to date with the sources')
+  subparsers.add_parser('languages', help='list every region and language, with their number of entries')
+  lookup_parser = subparsers.add_parser('lookup', help='find the text for a label in every language')
+  lookup_parser.add_argument('label')
+  search_parser = subparsers.add_parser('search', help='full-text search over labels and text')
+  search_parser.add_argument('query')
+  search_parser.add_argument('--limit', type=int, default=100)
+  search_parser.add_argument('--fts', action='store_true', help='use FTS5 query syntax (OR, NOT, prefix*) instead of searching for the query as a phrase')
+  for subparser in (lookup_parser, search_parser):
+    subparser.add_argument('--language', help='only show this language, e.g. EU_French or EUR/EU_French')
+    subparser.add_argument('--region', help='only show this region, e.g. EUR')
+  diff_parser = subparsers.add_parser('diff', help='list labels missing from, or identical in, another language')
+  diff_parser.add_argument('language')
+  diff_parser.add_argument('other_language')
+  diff_parser.add_argument('--same', action='store_true', help='also list labels whose text is the same in both languages, which are usually untranslated')
+  parser.add_argument('--catalog', default=CATALOG_PATH, help='catalog database path, defaults to %s' % CATALOG_PATH)
+  args = parser.parse_args()
+
+  catalog = Catalog.Open(args.catalog)
+  try:
+    start = time.perf_counter()
+    indexed, removed = catalog.update()
+    if args.command == 'update':
+      print('Indexed %d files, removed %d in %d ms' % (indexed, removed, (time.perf_counter() - start) * 1000))
+    elif args.command == 'languages':
+      for region, language, count in catalog.get_languages():
+        print('%s/%s: %d entries' % (region, language, count))
+    elif args.command == 'lookup':
+      print_entries(catalog.lookup(args.label, args.language, args.region))
+    elif args.command == 'search':
+      print_entries(catalog.search(args.query, args.language, args.region, args.limit, args.fts))
+    elif args.command == 'diff':
+      texts = catalog.get_texts(args.language)
+      other_texts = catalog.get_texts(args.other_language)
+      if not texts or not other_texts:
+        exit('Unknown language %s' % (args.language if not texts else args.other_language))
+      missing, extra, same = diff_texts(texts, other_texts)
+      print_keys('Missing from %s' % args.other_language, missing, texts)
+      print_keys('Only in %s' % args.other_language, extra, other_texts)
+      if args.same:
+        print_keys('Same text in both', same, texts)
+  finally:
+    catalog.close()
+
+if __name__ == '__main__':
+  main()
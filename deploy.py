@@ -0,0 +1,109 @@
+# Deploy tool for Flipnote Studio 3D patches
+# Copies the built luma folder to an SD card, only writing files that changed since the last deploy
+# build.py leaves a manifest of every output file in the luma folder, and a copy of it is kept on the card after each deploy
+# Usage: deploy.py <luma folder on the SD card> [--source luma] [--tenant name] [--verify] [--dry-run]
+
+import argparse
+import os
+import pathlib
+import sys
+
+from build import TENANTS_PATH
+from scripts.manifest import hash_file, load_manifest, save_manifest
+
+# SD cards are much faster with large sequential writes
+COPY_CHUNK_SIZE = 0x400000
+
+def copy_file(src_path, dest_path):
+  # Writes to a temporary file first and renames it into place, so a pulled card never has a half-written file
+  dest_path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = dest_path.with_name(dest_path.name + '.tmp')
+  with open(str(src_path), 'rb') as src, open(str(tmp_path), 'wb', buffering=COPY_CHUNK_SIZE) as dest:
+    for chunk in iter(lambda: src.read(COPY_CHUNK_SIZE), b''):
+      dest.write(chunk)
+    dest.flush()
+    os.fsync(dest.fileno())
+  os.replace(str(tmp_path), str(dest_path))
+
+def remove_file(root_path, path):
+  # Removes a file, along with any folders that are left empty, up to the root
+  try:
+    path.unlink()
+  except FileNotFoundError:
+    pass
+  parent = path.parent
+  while parent != root_path:
+    try:
+      parent.rmdir()
+    except OSError:
+      break
+    parent = parent.parent
+
+def is_unchanged(target_path, name, entry, target_files, verify):
+  # The target's manifest says what was last deployed, but the file itself also has to still be there
+  path = target_path / name
+  try:
+    size = path.stat().st_size
+  except OSError:
+    return False
+  if size != entry['size']:
+    return False
+  target_entry = target_files.get(name)
+  # Files that aren't in the target's manifest (e.g. copied by hand) are hashed, reading is cheap compared to writing
+  if verify or target_entry is None:
+    return hash_file(path) == entry['hash']
+  return target_entry['hash'] == entry['hash']
+
+def deploy(source_path, target_path, verify=False, dry_run=False):
+  files = load_manifest(source_path)
+  if not files:
+    exit('No manifest found in %s, run build.py first' % source_path)
+  target_files = load_manifest(target_path)
+  copied = []
+  unchanged = 0
+  for name, entry in sorted(files.items()):
+    if is_unchanged(target_path, name, entry, target_files, verify):
+      unchanged += 1
+      continue
+    copied.append(name)
+    print('Copying %s' % name)
+    if not dry_run:
+      copy_file(source_path / name, target_path / name)
+  # Only files that were deployed before are removed, anything else in the folder belongs to luma or other apps
+  removed = sorted(name for name in target_files if name not in files)
+  for name in removed:
+    print('Removing %s' % name)
+    if not dry_run:
+      remove_file(target_path, target_path / name)
+  if not dry_run:
+    # the manifest is saved last, so an interrupted deploy is picked up again on the next run
+    save_manifest(target_path, {name: {'size': entry['size'], 'hash': entry['hash']} for name, entry in files.items()})
+  copied_size = sum(files[name]['size'] for name in copied)
+  if dry_run:
+    print('Would copy %d files (%d KiB), would remove %d, %d unchanged' % (len(copied), copied_size // 1024, len(removed), unchanged))
+  else:
+    print('Copied %d files (%d KiB), removed %d, %d unchanged' % (len(copied), copied_size // 1024, len(removed), unchanged))
+
+def main():
+  parser = argparse.ArgumentParser(description='Copy changed luma patch files to an SD card')
+  parser.add_argument('target', help='the luma folder on the SD card')
+  parser.add_argument('--source', default='./luma', help='the built luma folder, defaults to ./luma')
+  parser.add_argument('--tenant', help='deploy the luma folder built for the [SETUP.TENANT] section instead')
+  parser.add_argument('--verify', action='store_true', help='hash files on the card instead of trusting its manifest')
+  parser.add_argument('--dry-run', action='store_true', help='only print what would be copied and removed')
+  args = parser.parse_args()
+
+  source_path = pathlib.Path(args.source)
+  if args.tenant is not None:
+    source_path = pathlib.Path(TENANTS_PATH) / args.tenant / 'luma'
+  target_path = pathlib.Path(args.target)
+  if source_path.resolve() == target_path.resolve():
+    exit('The source and target folders are the same')
+  if not target_path.is_dir():
+    print('Creating %s' % target_path, file=sys.stderr)
+    if not args.dry_run:
+      target_path.mkdir(parents=True)
+  deploy(source_path, target_path, args.verify, args.dry_run)
+
+if __name__ == '__main__':
+  main()
@@ -1,30 +1,109 @@
 # Small utility to extract a DARC file's contents to a folder
 # + Decompile .msbt translation files to an .msbt.json
+# BLZ compressed archives (.blz) are decompressed automatically
+# Usage: extract_darc.py <archive> <output dir> [entry names...]
+#        extract_darc.py --batch <romfs dir> <output dir> [<romfs dir> <output dir>...] [-j N]
+# If entry names are given, only those entries are extracted
+# Batch mode extracts every .blz and .arc archive in an extracted romfs tree into the same layout as the romfs sources,
+# so e.g. messageData/EU_French/SystemMessage.blz becomes <output dir>/messageData/EU_French/SystemMessage.blz/*.msbt.json
 
-from scripts.darc import Darc
+import scripts.blz as Blz
+from scripts.darc import Darc, is_darc
 from scripts.msbt import Msbt
 
-from sys import argv
+import argparse
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from io import BytesIO
-import json
-
-darc = Darc.Open(argv[1])
-outputDir = Path(argv[2])
-outputDir.mkdir(parents=True, exist_ok=True)
-
-for entry in darc.root.entries:
-  path = Path(entry.name)
-  # If the file is an .msbt, convert it to .msbt.json
-  if path.suffix == '.msbt':
-    msbt = Msbt()
-    msbt.read(BytesIO(entry.data))
-    filepath = outputDir / path
-    filepath = filepath.with_suffix('.msbt.json')
-    msbt.dump_json(filepath)
 
+def load_archive(path):
+  with open(str(path), 'rb') as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  if not is_darc(data):
+    compressed = data
+    data = Blz.decompress(compressed)
+    compressed.close()
+  # Entry data is only read from the archive as each entry is extracted
+  darc = Darc.from_bytes(data)
+  if isinstance(data, mmap.mmap):
+    darc.mapping = data
+  return darc
+
+def extract_darc(darc, output_dir, names=None):
+  if names is None:
+    names = [entry.name for entry in darc.root.entries]
+  else:
+    unknown = [name for name in names if name not in darc.index]
+    if unknown:
+      raise KeyError('Entries not found in archive: %s' % ', '.join(unknown))
+  output_dir.mkdir(parents=True, exist_ok=True)
+  for name in names:
+    path = Path(name)
+    # entry data is a view of the archive, so it doesn't get copied before being parsed or written
+    entry_data = darc.get(name)
+    # If the file is an .msbt, convert it to .msbt.json
+    if path.suffix == '.msbt':
+      msbt = Msbt.from_bytes(entry_data)
+      filepath = output_dir / path
+      filepath = filepath.with_suffix('.msbt.json')
+      msbt.dump_json(filepath)
+
+    else:
+      filepath = output_dir / path
+      with filepath.open(mode='wb') as fp:
+        fp.write(entry_data)
+    entry_data.release()
+  return len(names)
+
+def extract_archive(path, output_dir):
+  with load_archive(path) as darc:
+    return extract_darc(darc, output_dir)
+
+def find_archives(romfs_path, output_path, archives):
+  # Collects (archive path, output dir) pairs for every archive in a romfs tree
+  for child in sorted(romfs_path.iterdir()):
+    if child.is_dir():
+      find_archives(child, output_path / child.name, archives)
+    elif child.suffix in ('.blz', '.arc'):
+      archives.append((child, output_path / child.name))
+  return archives
+
+def extract_batch(pairs, jobs=1):
+  archives = []
+  for romfs_path, output_path in pairs:
+    find_archives(romfs_path, output_path, archives)
+  # Only the paths are sent to the workers, each one maps and decompresses its own archive
+  if jobs == 1 or len(archives) < 2:
+    counts = [extract_archive(path, output_dir) for path, output_dir in archives]
   else:
-    filepath = outputDir / path
-    with filepath.open(mode='wb') as fp:
-      fp.write(entry.data)
-    
\ No newline at end of file
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+      counts = list(executor.map(extract_archive, *zip(*archives)))
+  return len(archives), sum(counts)
+
+def main():
+  parser = argparse.ArgumentParser(description='Extract DARC archives, decompiling .msbt files to .msbt.json')
+  parser.add_argument('paths', nargs='+', help='<archive> <output dir> [entry names...], or pairs of <romfs dir> <output dir> with --batch')
+  parser.add_argument('--batch', action='store_true', help='extract every archive in one or more extracted romfs folders')
+  parser.add_argument('-j', '--jobs', type=int, default=0, help='number of archives to extract in parallel in batch mode, 0 uses every core')
+  args = parser.parse_args()
+
+  if args.batch:
+    if len(args.paths) % 2:
+      parser.error('--batch needs a <romfs dir> <output dir> pair for each romfs folder')
+    pairs = [(Path(args.paths[i]), Path(args.paths[i + 1])) for i in range(0, len(args.paths), 2)]
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    num_archives, num_entries = extract_batch(pairs, jobs)
+    print('Extracted %d entries from %d archives' % (num_entries, num_archives))
+    return
+
+  if len(args.paths) < 2:
+    parser.error('an archive and output folder are required')
+  with load_archive(args.paths[0]) as darc:
+    try:
+      extract_darc(darc, Path(args.paths[1]), args.paths[2:] or None)
+    except KeyError as error:
+      exit(error.args[0])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,156 @@
+# Offset finder for new versions of Flipnote Studio 3D
+# Scans a decrypted code.bin for the byte signatures around each patch site, and prints a ready config.ini section
+# Signatures are learned from a code.bin whose offsets are already known, and stored in signatures.json
+# Usage: find_offsets.py learn <code.bin> <region>
+#        find_offsets.py scan <code.bin> <region> [--title-id ID]
+
+import argparse
+import json
+import pathlib
+import sys
+from collections import Counter
+
+from build import REGIONS, load_config
+from scripts.sigscan import SignatureScanner
+
+SIGNATURES_PATH = './signatures.json'
+# config keys for each patch site, in the order they appear in config.ini
+OFFSET_KEYS = ['CERT_A_SIZE', 'CERT_B_SIZE', 'NASC_BRANCH', 'CERT_A_DATA', 'CERT_B_DATA', 'GALLERY_URL']
+# length of each learned signature fragment
+FRAGMENT_SIZE = 16
+
+def get_site_sizes(setup_config):
+  # number of bytes that each patch site covers
+  return {
+    'CERT_A_SIZE': 4,
+    'CERT_B_SIZE': 4,
+    'NASC_BRANCH': 4,
+    'CERT_A_DATA': int(setup_config['CERT_A_SIZE_MAX']),
+    'CERT_B_DATA': int(setup_config['CERT_B_SIZE_MAX']),
+    'GALLERY_URL': int(setup_config['GALLERY_URL_SIZE_MAX']),
+  }
+
+def get_builtin_signatures(setup_config):
+  # The original certs take up all of the space reserved for them, so we know the length in their DER headers
+  # a DER cert starts with two long-form SEQUENCE headers, the first of which covers the whole cert
+  signatures = {}
+  for key, size_key in [('CERT_A_DATA', 'CERT_A_SIZE_MAX'), ('CERT_B_DATA', 'CERT_B_SIZE_MAX')]:
+    header = b'\x30\x82' + (int(setup_config[size_key]) - 4).to_bytes(2, byteorder='big') + b'\x30\x82'
+    signatures[key] = [{'pattern': header.hex(), 'delta': 0, 'source': 'DER header'}]
+  return signatures
+
+def load_signatures(path):
+  try:
+    with open(path, 'r') as fp:
+      return json.loads(fp.read())
+  except FileNotFoundError:
+    return {}
+
+def save_signatures(path, signatures):
+  with open(path, 'w') as fp:
+    fp.write(json.dumps(signatures, indent=2, sort_keys=True))
+
+def learn_signatures(data, offsets, site_sizes, source):
+  # Takes fragments from just before, at the start of, and just after each patch site
+  # Only fragments that are unique in the binary are kept, since anything else can't identify the site
+  signatures = {}
+  for key in OFFSET_KEYS:
+    site = offsets[key]
+    size = site_sizes[key]
+    fragments = []
+    for start, delta in [(site - FRAGMENT_SIZE, FRAGMENT_SIZE), (site, 0), (site + size, -size)]:
+      fragment = data[start:start + FRAGMENT_SIZE]
+      if start < 0 or len(fragment) < FRAGMENT_SIZE:
+        continue
+      first = data.find(fragment)
+      if data.find(fragment, first + 1) != -1:
+        continue
+      fragments.append({'pattern': fragment.hex(), 'delta': delta, 'source': source})
+    signatures[key] = fragments
+  return signatures
+
+def find_offsets(data, signatures):
+  # Scans the binary once for every fragment, each match votes for the site offset it implies
+  fragments = []
+  for key in OFFSET_KEYS:
+    for fragment in signatures.get(key, []):
+      fragments.append((key, bytes.fromhex(fragment['pattern']), fragment['delta']))
+  scanner = SignatureScanner([pattern for key, pattern, delta in fragments])
+  votes = {key: Counter() for key in OFFSET_KEYS}
+  for index, offset in scanner.scan(data):
+    key, pattern, delta = fragments[index]
+    votes[key][offset + delta] += 1
+  # Returns the winning offset for each key, or a list of tied candidates if there isn't a clear winner
+  results = {}
+  for key in OFFSET_KEYS:
+    candidates = votes[key].most_common()
+    if not candidates:
+      results[key] = []
+    elif len(candidates) > 1 and candidates[0][1] == candidates[1][1]:
+      results[key] = sorted(offset for offset, count in candidates if count == candidates[0][1])
+    else:
+      results[key] = candidates[0][0]
+  return results
+
+def merge_signatures(signatures, learned):
+  for key, fragments in learned.items():
+    existing = signatures.setdefault(key, [])
+    for fragment in fragments:
+      if not any(item['pattern'] == fragment['pattern'] and item['delta'] == fragment['delta'] for item in existing):
+        existing.append(fragment)
+  return signatures
+
+def main():
+  parser = argparse.ArgumentParser(description='Find patch offsets in a decrypted Flipnote Studio 3D code.bin')
+  subparsers = parser.add_subparsers(dest='command')
+  learn_parser = subparsers.add_parser('learn', help='learn signatures from a code.bin whose offsets are in config.ini')
+  learn_parser.add_argument('codebin')
+  learn_parser.add_argument('region')
+  scan_parser = subparsers.add_parser('scan', help='find offsets in a new code.bin')
+  scan_parser.add_argument('codebin')
+  scan_parser.add_argument('region')
+  scan_parser.add_argument('--title-id', help='title ID for the config section, defaults to the region\'s current one')
+  args = parser.parse_args()
+  if args.command is None:
+    parser.error('a command is required')
+
+  config = load_config('config.ini')
+  data = pathlib.Path(args.codebin).read_bytes()
+
+  if args.command == 'learn':
+    # Offsets can only be learned from a region that config.ini already has
+    if args.region not in REGIONS or args.region not in config:
+      exit('Unknown region %s, expected one of %s' % (args.region, ', '.join(REGIONS)))
+    region_config = config[args.region]
+    offsets = {key: int(region_config[key]) for key in OFFSET_KEYS}
+    learned = learn_signatures(data, offsets, get_site_sizes(config['SETUP']), args.region)
+    signatures = merge_signatures(load_signatures(SIGNATURES_PATH), learned)
+    save_signatures(SIGNATURES_PATH, signatures)
+    for key in OFFSET_KEYS:
+      print('%s: %d unique fragments' % (key, len(learned[key])))
+    return
+
+  signatures = merge_signatures(get_builtin_signatures(config['SETUP']), load_signatures(SIGNATURES_PATH))
+  results = find_offsets(data, signatures)
+  failed = False
+  title_id = args.title_id
+  if title_id is None and args.region in config:
+    title_id = config[args.region]['TITLE_ID']
+  print('[%s]' % args.region)
+  print('TITLE_ID = %s' % (title_id or ''))
+  for key in OFFSET_KEYS:
+    result = results[key]
+    if isinstance(result, list):
+      failed = True
+      print('%s = ' % key)
+      if result:
+        print('%s is ambiguous, candidates: %s' % (key, ', '.join(str(offset) for offset in result)), file=sys.stderr)
+      else:
+        print('%s could not be found' % key, file=sys.stderr)
+    else:
+      print('%s = %d' % (key, result))
+  if failed:
+    exit(1)
+
+if __name__ == '__main__':
+  main()
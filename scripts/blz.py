@@ -0,0 +1,241 @@
+# BLZ lib
+# Compresses and decompresses files with the backwards LZ ("bottom LZ") compression used by .blz archives
+# Output is bit-compatible with CUE's blz.c in normal mode (blz -en)
+# github.com/thejsa/705a59a6c63989f752a32ce94b1849aa
+
+# Format
+# ======
+# Compressed files are decoded backwards, starting from the end of the file
+# - uncompressed data, left as-is
+# - compressed data, stored in reverse byte order
+#   - uint8 flags - one bit per token, highest bit first (1 = back reference, 0 = literal byte)
+#   - literal: uint8 byte
+#   - back reference: uint16 (big endian) - upper 4 bits are (length - 3), lower 12 bits are (distance - 3)
+# - 0xFF padding, so that the footer is 4-byte aligned
+# Footer
+# - uint24 compressed data size + footer size
+# - uint8 footer size (8 - 11 bytes, including the padding)
+# - uint32 extra size of the decompressed file compared to the compressed file
+# If the extra size is 0, the file isn't compressed and the data is only padded to a multiple of 4 bytes
+
+import struct
+
+BLZ_THRESHOLD = 2
+BLZ_N = 0x1002
+BLZ_F = 0x12
+
+class BlzError(Exception):
+  pass
+
+def find_match(raw, pos, lo, max_len):
+  # Find the longest match for raw[pos:] within raw[lo:pos], preferring the closest one on ties
+  # Matches can't overlap the current position
+  end = pos
+  if end - lo <= BLZ_THRESHOLD:
+    return 0, 0
+  start = raw.rfind(raw[pos:pos + BLZ_THRESHOLD + 1], lo, end)
+  if start < 0:
+    return 0, 0
+  length = BLZ_THRESHOLD + 1
+  while length < max_len:
+    # The closest match of this length is also the closest candidate for the next length,
+    # so try to extend it in-place before searching further back in the window
+    if start + length < end and raw[start + length] == raw[pos + length]:
+      length += 1
+      continue
+    found = raw.rfind(raw[pos:pos + length + 1], lo, end)
+    if found < 0:
+      break
+    start = found
+    length += 1
+  return length, pos - start
+
+def common_prefix_length(a, b):
+  # Length of the longest common prefix of two buffers, comparing slices so the work stays in C
+  size = min(len(a), len(b))
+  if a[:size] == b[:size]:
+    return size
+  lo = 0
+  hi = size
+  while hi - lo > 1:
+    middle = (lo + hi) // 2
+    if a[lo:middle] == b[lo:middle]:
+      lo = middle
+    else:
+      hi = middle
+  return lo
+
+def compress(data):
+  return BlzCompressor().compress(data)
+
+class BlzCompressor:
+  # Compresses successive versions of the same file, like an archive that's being edited
+  # Compression runs from the end of the file, and every token only depends on the data after it,
+  # so the state from the previous version can be reused for as long as the end of the file hasn't changed
+  # Output is always identical to compress()
+  def __init__(self, interval=0x400):
+    # the reversed input and compressed output of the previous file
+    self.raw = bytes(0)
+    self.pak = bytearray()
+    # (pos, len(pak), pak_tmp, pak_tmp_pos) at the start of a flag byte, roughly every interval input bytes
+    self.checkpoints = []
+    self.interval = interval
+
+  def resume(self, raw):
+    # Find the last checkpoint whose tokens can't have been affected by changes to the file
+    # a token at pos can read ahead up to BLZ_F bytes, so everything before pos + BLZ_F must be unchanged
+    valid = common_prefix_length(self.raw, raw) - BLZ_F
+    checkpoints = self.checkpoints
+    while checkpoints and checkpoints[-1][0] > valid:
+      checkpoints.pop()
+    if not checkpoints:
+      self.pak = bytearray()
+      return 0, 0, 0
+    pos, pak_len, pak_tmp, pak_tmp_pos = checkpoints[-1]
+    del self.pak[pak_len:]
+    return pos, pak_tmp, pak_tmp_pos
+
+  def compress(self, data):
+    raw_len = len(data)
+    # Compression runs backwards from the end of the file
+    raw = bytes(data[::-1])
+    pos, pak_tmp, pak_tmp_pos = self.resume(raw)
+    pak = self.pak
+    checkpoints = self.checkpoints
+    interval = self.interval
+    # Track the point at which compressed data + remaining uncompressed data is smallest
+    # that's where len(pak) - pos is lowest, which doesn't depend on the file size
+    next_checkpoint = pos + interval
+
+    flag_pos = 0
+    mask = 0
+    while pos < raw_len:
+      mask >>= 1
+      if not mask:
+        if pos >= next_checkpoint:
+          checkpoints.append((pos, len(pak), pak_tmp, pak_tmp_pos))
+          next_checkpoint = pos + interval
+        flag_pos = len(pak)
+        pak.append(0)
+        mask = 0x80
+
+      max_len = min(BLZ_F, raw_len - pos)
+      length = 0
+      if max_len > BLZ_THRESHOLD:
+        length, distance = find_match(raw, pos, max(0, pos - BLZ_N), max_len)
+
+      if length > BLZ_THRESHOLD:
+        pak[flag_pos] = ((pak[flag_pos] << 1) | 1) & 0xFF
+        pak.append(((length - (BLZ_THRESHOLD + 1)) << 4) | ((distance - 3) >> 8))
+        pak.append((distance - 3) & 0xFF)
+        pos += length
+      else:
+        pak[flag_pos] = (pak[flag_pos] << 1) & 0xFF
+        pak.append(raw[pos])
+        pos += 1
+
+      if len(pak) - pos < pak_tmp - pak_tmp_pos:
+        pak_tmp = len(pak)
+        pak_tmp_pos = pos
+    self.raw = raw
+    raw_tmp = raw_len - pak_tmp_pos
+
+    # shift the last flag byte so that its flags start from the highest bit
+    # this byte is never part of a checkpoint, so pak can still be reused afterwards
+    while mask and mask != 1:
+      mask >>= 1
+      pak[flag_pos] = (pak[flag_pos] << 1) & 0xFF
+
+    # If compression doesn't help, store the file as-is
+    if not pak_tmp or raw_len + 4 < ((pak_tmp + raw_tmp + 3) & -4) + 8:
+      result = bytearray(data)
+      result += bytes(-len(result) % 4)
+      result += bytes(4)
+      return bytes(result)
+
+    result = bytearray(data[:raw_tmp])
+    result += pak[pak_tmp - 1::-1]
+    header_len = 8
+    inc_len = raw_len - pak_tmp - raw_tmp
+    while len(result) & 3:
+      result.append(0xFF)
+      header_len += 1
+    result += struct.pack('<I', pak_tmp + header_len)[:3]
+    result.append(header_len)
+    # blz.c lets this wrap around if the footer outweighs the savings, so we do too
+    result += struct.pack('<I', (inc_len - header_len) & 0xFFFFFFFF)
+    return bytes(result)
+
+def decompress(data):
+  if len(data) < 4:
+    raise BlzError('BLZ file is too small')
+  inc_len = struct.unpack_from('<I', data, len(data) - 4)[0]
+  # Files that weren't compressed only have 4 bytes of footer
+  if inc_len == 0:
+    return bytes(data[:len(data) - 4])
+
+  if len(data) < 8:
+    raise BlzError('BLZ file is too small')
+  header_len = data[len(data) - 5]
+  if header_len < 0x08 or header_len > 0x0B:
+    raise BlzError('Invalid BLZ footer size')
+  enc_len = struct.unpack_from('<I', data, len(data) - 8)[0] & 0x00FFFFFF
+  if enc_len < header_len or enc_len > len(data):
+    raise BlzError('Invalid BLZ compressed size')
+  dec_len = len(data) - enc_len
+  raw_len = (dec_len + enc_len + inc_len) & 0xFFFFFFFF
+
+  pak = bytes(data[dec_len:len(data) - header_len])[::-1]
+  pak_len = len(pak)
+  raw_end = raw_len - dec_len
+  raw = bytearray()
+  pos = 0
+  mask = 0
+  flags = 0
+  while len(raw) < raw_end:
+    mask >>= 1
+    if not mask:
+      if pos == pak_len:
+        break
+      flags = pak[pos]
+      pos += 1
+      mask = 0x80
+
+    if not flags & mask:
+      if pos == pak_len:
+        break
+      raw.append(pak[pos])
+      pos += 1
+    else:
+      if pos + 1 >= pak_len:
+        break
+      token = (pak[pos] << 8) | pak[pos + 1]
+      pos += 2
+      length = min((token >> 12) + BLZ_THRESHOLD + 1, raw_end - len(raw))
+      distance = (token & 0xFFF) + 3
+      if distance > len(raw):
+        raise BlzError('Invalid BLZ back reference')
+      start = len(raw) - distance
+      if length <= distance:
+        raw += raw[start:start + length]
+      else:
+        for i in range(length):
+          raw.append(raw[start + i])
+
+  raw.reverse()
+  return bytes(data[:dec_len]) + bytes(raw)
+
+if __name__ == '__main__':
+  from sys import argv
+
+  # usage: blz.py -en|-d <input> [output]
+  with open(argv[2], 'rb') as f:
+    data = f.read()
+  if argv[1] == '-en':
+    data = compress(data)
+  elif argv[1] == '-d':
+    data = decompress(data)
+  else:
+    exit('Unknown mode %s, use -en to compress or -d to decompress' % argv[1])
+  with open(argv[3] if len(argv) > 3 else argv[2], 'wb') as f:
+    f.write(data)
@@ -0,0 +1,190 @@
+# Build cache lib
+# Keeps track of which romfs archives are already up to date, so that unchanged archives can be skipped on rebuild
+# Archives are keyed by a hash of their input files, the compiler version and the output endianness
+# Build artifacts are also kept in a content-addressed store, so identical inputs are only ever compiled once
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import threading
+
+MANIFEST_VERSION = 1
+
+def hash_bytes(data):
+  return hashlib.sha1(data).hexdigest()
+
+def hash_file(path, chunk_size=0x10000):
+  # Files are hashed in chunks so that large ones don't have to be loaded all at once
+  digest = hashlib.sha1()
+  with open(str(path), 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def compiler_fingerprint(paths):
+  # Hash the source of everything that takes part in compiling an archive
+  # so that any change to the compilers invalidates the whole cache
+  digest = hashlib.sha1()
+  for path in paths:
+    path = pathlib.Path(path)
+    digest.update(path.name.encode('utf-8'))
+    if path.is_file():
+      digest.update(path.read_bytes())
+  return digest.hexdigest()
+
+class ArtifactStore:
+  # Each artifact is saved once under the hash of its inputs, and outputs are hardlinked to that copy
+  # so identical outputs, even across regions and tenants, share the same data on disk
+  # Objects are never modified in place, so anything that writes to an output has to replace the file instead
+  def __init__(self, path, fingerprint=''):
+    self.path = pathlib.Path(path)
+    self.fingerprint = fingerprint
+
+  def key(self, kind, *parts):
+    # Keys always include the compiler fingerprint, since objects outlive the manifest
+    digest = hashlib.sha1()
+    digest.update(self.fingerprint.encode('ascii'))
+    digest.update(kind.encode('ascii') + b'\x00')
+    for part in parts:
+      digest.update(part.encode('utf-8') if isinstance(part, str) else part)
+      digest.update(b'\x00')
+    return digest.hexdigest()
+
+  def object_path(self, key):
+    return self.path / key[:2] / key
+
+  def touch(self, path):
+    # Marks an object as used by this build so that prune() keeps it
+    # objects that are linked to an output are always kept, and touching them would change the output's mtime
+    try:
+      if os.stat(str(path)).st_nlink == 1:
+        os.utime(str(path))
+      return True
+    except OSError:
+      return False
+
+  def has(self, key):
+    return self.touch(self.object_path(key))
+
+  def get(self, key):
+    path = self.object_path(key)
+    if not self.touch(path):
+      return None
+    return path.read_bytes()
+
+  def put(self, key, data):
+    self.put_file(key, lambda path: path.write_bytes(data))
+
+  def put_file(self, key, save):
+    # Stores an object by calling save() with the path to write it to, so large objects can be streamed to disk
+    # Returns whatever save() returns
+    path = self.object_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # the temp name is unique per process and thread, since workers can store the same object at the same time
+    tmp_path = path.with_name('%s.%d.%d.tmp' % (key, os.getpid(), threading.get_ident()))
+    result = save(tmp_path)
+    os.replace(str(tmp_path), str(path))
+    return result
+
+  def link(self, key, output_path):
+    # Hardlinks an object to an output path, replacing whatever was there
+    # The object is copied instead if hardlinks aren't supported
+    path = str(self.object_path(key))
+    output_path = str(output_path)
+    if os.path.exists(output_path):
+      if os.path.samefile(path, output_path):
+        return
+      os.unlink(output_path)
+    try:
+      os.link(path, output_path)
+    except OSError:
+      shutil.copy2(path, output_path)
+
+  def prune(self, before):
+    # Removes objects that no output is linked to and that haven't been used since the given time
+    if not self.path.exists():
+      return
+    for child in self.path.iterdir():
+      if not child.is_dir():
+        continue
+      for path in child.iterdir():
+        stat = path.stat()
+        if stat.st_nlink == 1 and stat.st_mtime < before:
+          path.unlink()
+
+class BuildCache:
+  def __init__(self, path, fingerprint=''):
+    self.path = pathlib.Path(path)
+    self.fingerprint = fingerprint
+    self.store = ArtifactStore(self.path / 'objects', fingerprint)
+    self.entries = {}
+    self.seen = set()
+
+  @classmethod
+  def Open(cls, path, fingerprint=''):
+    cache = cls(path, fingerprint)
+    cache.load()
+    return cache
+
+  def load(self):
+    manifest_path = self.path / 'manifest.json'
+    try:
+      with manifest_path.open('r') as fp:
+        manifest = json.loads(fp.read())
+    except (OSError, ValueError):
+      return
+    # Throw away the whole cache if it was written by a different compiler
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('fingerprint') != self.fingerprint:
+      return
+    self.entries = manifest.get('entries', {})
+
+  def save(self):
+    self.path.mkdir(parents=True, exist_ok=True)
+    # Drop entries for outputs that weren't produced by this build
+    entries = {key: value for key, value in self.entries.items() if key in self.seen}
+    manifest = {
+      'version': MANIFEST_VERSION,
+      'fingerprint': self.fingerprint,
+      'entries': entries,
+    }
+    manifest_path = self.path / 'manifest.json'
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with tmp_path.open('w') as fp:
+      fp.write(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(str(tmp_path), str(manifest_path))
+
+  def archive_key(self, src_path, endian='<', compress=False, pool_strings=False):
+    # Key an archive by the name and content of every file that goes into it
+    digest = hashlib.sha1()
+    digest.update(endian.encode('ascii'))
+    digest.update(b'blz' if compress else b'darc')
+    digest.update(b'pool' if pool_strings else b'')
+    for child in sorted(src_path.iterdir()):
+      digest.update(child.name.encode('utf-8') + b'\x00')
+      digest.update(hash_file(child).encode('ascii'))
+    return digest.hexdigest()
+
+  def is_fresh(self, output_path, key):
+    output_key = str(output_path)
+    self.seen.add(output_key)
+    entry = self.entries.get(output_key)
+    if entry is None or entry['key'] != key:
+      return False
+    # Make sure the previous output is still there and hasn't been touched since
+    try:
+      stat = os.stat(output_key)
+    except OSError:
+      return False
+    return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+  def update(self, output_path, key):
+    output_key = str(output_path)
+    stat = os.stat(output_key)
+    self.seen.add(output_key)
+    self.entries[output_key] = {
+      'key': key,
+      'size': stat.st_size,
+      'mtime': stat.st_mtime_ns,
+    }
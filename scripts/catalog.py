@@ -0,0 +1,208 @@
+# Translation catalog lib
+# Indexes every .msbt.json source file into an SQLite database, so labels and strings can be looked up without parsing hundreds of JSON files
+# Entries are keyed by region, language, archive, file, group and label, with a full-text index over labels and text
+# Files are only parsed again when their size and mtime change and their contents hash differently
+
+import pathlib
+import sqlite3
+
+from scripts.cache import hash_file
+from scripts.msbt import Msbt
+
+CATALOG_VERSION = 1
+SOURCE_SUFFIX = '.msbt.json'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+  id INTEGER PRIMARY KEY,
+  path TEXT UNIQUE NOT NULL,
+  region TEXT NOT NULL,
+  language TEXT NOT NULL,
+  archive TEXT NOT NULL,
+  name TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  mtime INTEGER NOT NULL,
+  hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+  id INTEGER PRIMARY KEY,
+  file_id INTEGER NOT NULL REFERENCES files(id),
+  group_index INTEGER NOT NULL,
+  label TEXT NOT NULL,
+  text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_file ON entries(file_id);
+CREATE INDEX IF NOT EXISTS entries_label ON entries(label);
+CREATE INDEX IF NOT EXISTS files_language ON files(language, region);
+'''
+
+# Rows for queries, with the full key of each entry
+ENTRY_QUERY = '''
+SELECT files.region, files.language, files.archive, files.name, entries.group_index, entries.label, entries.text
+FROM entries JOIN files ON files.id = entries.file_id
+'''
+
+def split_source_path(root_path, path):
+  # <region>/romfs/<folders>/<language>/<archive>.blz/<file>.msbt.json -> (region, language, archive, file)
+  # The language is the folder that holds the archive, e.g. messageData/EU_French/SystemMessage.blz
+  parts = path.relative_to(root_path).parts
+  region = parts[0]
+  folders = list(parts[2:-1])
+  archive = ''
+  name = [parts[-1][:-len('.json')]]
+  # Archives can contain folders of their own
+  for i in range(len(folders) - 1, -1, -1):
+    if folders[i].endswith('.blz') or folders[i].endswith('.arc'):
+      archive = folders[i]
+      name = folders[i + 1:] + name
+      folders = folders[:i]
+      break
+  language = folders[-1] if folders else ''
+  return region, language, archive, '/'.join(name)
+
+def split_language(language):
+  # Languages can be given as 'EU_French' or 'EUR/EU_French'
+  if '/' in language:
+    region, language = language.split('/', 1)
+    return region, language
+  return None, language
+
+def diff_texts(texts, other_texts):
+  # Compares two languages' {(archive, file, label): text} dicts
+  # Returns the keys missing from the other language, the keys only in the other language, and the keys whose text is identical (probably untranslated)
+  missing = sorted(key for key in texts if key not in other_texts)
+  extra = sorted(key for key in other_texts if key not in texts)
+  same = sorted(key for key, text in texts.items() if other_texts.get(key) == text and text.strip())
+  return missing, extra, same
+
+class Catalog:
+  def __init__(self, db, root_path='.'):
+    self.db = db
+    self.root_path = pathlib.Path(root_path)
+    self.has_fts = False
+
+  @classmethod
+  def Open(cls, path, root_path='.'):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    catalog = cls(sqlite3.connect(str(path)), root_path)
+    catalog.setup()
+    return catalog
+
+  def close(self):
+    self.db.close()
+
+  def setup(self):
+    db = self.db
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    # Older catalogs are simply thrown away, they can always be rebuilt from the sources
+    if version != CATALOG_VERSION:
+      db.executescript('DROP TABLE IF EXISTS entries_fts; DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS files;')
+    db.executescript(SCHEMA)
+    # FTS5 is built into most sqlite3 builds, if it's missing search falls back to a (slower) LIKE scan
+    try:
+      db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(label, text)')
+      self.has_fts = True
+    except sqlite3.OperationalError:
+      self.has_fts = False
+    db.execute('PRAGMA user_version = %d' % CATALOG_VERSION)
+    db.commit()
+
+  def find_sources(self):
+    # Every <region>/romfs folder is indexed, including ALL
+    for romfs_path in sorted(self.root_path.glob('*/romfs')):
+      for path in sorted(romfs_path.rglob('*' + SOURCE_SUFFIX)):
+        yield path
+
+  def update(self):
+    # Returns the number of files that were (re)indexed and removed
+    db = self.db
+    known = {row[0]: row[1:] for row in db.execute('SELECT path, id, size, mtime, hash FROM files')}
+    indexed = 0
+    seen = set()
+    with db:
+      for path in self.find_sources():
+        name = path.relative_to(self.root_path).as_posix()
+        seen.add(name)
+        stat = path.stat()
+        row = known.get(name)
+        if row is not None and row[1] == stat.st_size and row[2] == stat.st_mtime_ns:
+          continue
+        digest = hash_file(path)
+        if row is not None and row[3] == digest:
+          # Touched but not changed
+          db.execute('UPDATE files SET size = ?, mtime = ? WHERE id = ?', (stat.st_size, stat.st_mtime_ns, row[0]))
+          continue
+        if row is not None:
+          self.remove_file(row[0])
+        self.add_file(path, name, stat, digest)
+        indexed += 1
+      removed = [row[0] for name, row in known.items() if name not in seen]
+      for file_id in removed:
+        self.remove_file(file_id)
+    return indexed, len(removed)
+
+  def add_file(self, path, name, stat, digest):
+    db = self.db
+    region, language, archive, file_name = split_source_path(self.root_path, path)
+    cursor = db.execute('INSERT INTO files (path, region, language, archive, name, size, mtime, hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (name, region, language, archive, file_name, stat.st_size, stat.st_mtime_ns, digest))
+    file_id = cursor.lastrowid
+    msbt = Msbt.from_json(str(path))
+    for group_index, group in enumerate(msbt.groups):
+      for entry in group.entries:
+        cursor = db.execute('INSERT INTO entries (file_id, group_index, label, text) VALUES (?, ?, ?, ?)', (file_id, group_index, entry.label, entry.text))
+        if self.has_fts:
+          db.execute('INSERT INTO entries_fts (rowid, label, text) VALUES (?, ?, ?)', (cursor.lastrowid, entry.label, entry.text))
+
+  def remove_file(self, file_id):
+    db = self.db
+    if self.has_fts:
+      db.execute('DELETE FROM entries_fts WHERE rowid IN (SELECT id FROM entries WHERE file_id = ?)', (file_id,))
+    db.execute('DELETE FROM entries WHERE file_id = ?', (file_id,))
+    db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+  def get_filter(self, language=None, region=None):
+    # Returns a WHERE clause fragment and its parameters
+    clauses = []
+    params = []
+    if language is not None:
+      language_region, language = split_language(language)
+      region = language_region or region
+      clauses.append('files.language = ?')
+      params.append(language)
+    if region is not None:
+      clauses.append('files.region = ?')
+      params.append(region)
+    return ''.join(' AND ' + clause for clause in clauses), params
+
+  def lookup(self, label, language=None, region=None):
+    # Labels can use glob wildcards, e.g. WindowInfo_Title_*
+    where, params = self.get_filter(language, region)
+    op = 'GLOB' if any(char in label for char in '*?[') else '='
+    return self.db.execute(ENTRY_QUERY + 'WHERE entries.label %s ?%s ORDER BY files.path, entries.label' % (op, where), [label] + params).fetchall()
+
+  def search(self, query, language=None, region=None, limit=100, raw=False):
+    # By default the query is searched for as a phrase, so text like Wi-Fi or don't doesn't get read as FTS5 syntax
+    # With raw, the query uses FTS5 query syntax instead, e.g. '"choisir une" OR dossier' or 'text: gallery*'
+    where, params = self.get_filter(language, region)
+    if self.has_fts:
+      match = query if raw else '"%s"' % query.replace('"', '""')
+      sql = ENTRY_QUERY + 'JOIN entries_fts ON entries_fts.rowid = entries.id WHERE entries_fts MATCH ?%s ORDER BY entries_fts.rank LIMIT ?' % where
+      try:
+        return self.db.execute(sql, [match] + params + [limit]).fetchall()
+      # Invalid FTS5 queries fall back to a plain substring search
+      except sqlite3.OperationalError:
+        pass
+    # LIKE wildcards in the query are escaped, so that e.g. 100% only matches itself
+    sql = ENTRY_QUERY + "WHERE (entries.text LIKE ? ESCAPE '\\' OR entries.label LIKE ? ESCAPE '\\')%s ORDER BY files.path LIMIT ?" % where
+    pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return self.db.execute(sql, [pattern, pattern] + params + [limit]).fetchall()
+
+  def get_texts(self, language):
+    # Returns {(archive, file, label): text} for one language
+    where, params = self.get_filter(language)
+    rows = self.db.execute('SELECT files.archive, files.name, entries.label, entries.text FROM entries JOIN files ON files.id = entries.file_id WHERE 1%s' % where, params)
+    return {(archive, name, label): text for archive, name, label, text in rows}
+
+  def get_languages(self):
+    return self.db.execute('SELECT files.region, files.language, COUNT(entries.id) FROM files JOIN entries ON entries.file_id = files.id GROUP BY files.region, files.language ORDER BY files.region, files.language').fetchall()
@@ -4,12 +4,107 @@
 # Written by Jaames
 # github.com/jaames | jamesdaniel.dev
 
+import contextlib
+import mmap
+import os
 import struct
 
+# Entry data is streamed to files in chunks of this size
+DARC_CHUNK_SIZE = 0x10000
+
+def is_darc(data):
+  # BLZ compression leaves the start of a file as-is, so compressed archives can also begin with a DARC header
+  # An uncompressed archive's header filesize will always match the size of the data though
+  if len(data) < 28 or data[:4] != b'darc':
+    return False
+  endian = '<' if data[4:6] == b'\xff\xfe' else '>'
+  return struct.unpack_from('%sI'%endian, data, 12)[0] == len(data)
+
+def align(offset, alignment=0x80):
+  return offset + (-offset % alignment)
+
+class DarcLayout:
+  def __init__(self):
+    self.entries = []
+    self.labels = []
+    self.label_offsets = []
+    self.data_offsets = []
+    self.num_entries = 0
+    self.table_size = 0
+    self.data_offset = 0
+    self.size = 0
+
+class FileSource:
+  # Reads entry data from a file only when it's needed
+  def __init__(self, path):
+    self.path = str(path)
+    self.size = os.path.getsize(self.path)
+
+  def __call__(self, offset, size):
+    with self.open() as read:
+      return read(offset, size)
+
+  def open(self):
+    # Keeps the file open while an entry is read in several chunks
+    return FileReader(self.path)
+
+class FileReader:
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.file.close()
+
+  def __call__(self, offset, size):
+    self.file.seek(offset)
+    return self.file.read(size)
+
 class DarcEntry:
-  def __init__(self, name='', data=bytes(0)):
+  def __init__(self, name='', data=bytes(0), size=None, read=None):
     self.name = name
     self.data = data
+    # Lazy entries have no data, instead read(offset, size) is called to get it when the archive is written
+    # their size has to be known up front, since it's needed for the archive layout
+    self.size = size
+    self.read = read
+
+  def is_lazy(self):
+    return self.read is not None
+
+  def get_size(self):
+    return self.size if self.is_lazy() else len(self.data)
+
+  def get_data(self):
+    if not self.is_lazy():
+      return self.data
+    return self.read_chunk(0, self.size)
+
+  def open_reader(self):
+    # Sources that can stay open (e.g. FileSource) are only opened once for all of an entry's chunks
+    if hasattr(self.read, 'open'):
+      return self.read.open()
+    return contextlib.nullcontext(self.read)
+
+  def read_chunk(self, offset, size, read=None):
+    chunk = (read or self.read)(offset, size)
+    if len(chunk) != size:
+      raise ValueError('DARC entry %s returned %d bytes at offset %d, expected %d' % (self.name, len(chunk), offset, size))
+    return chunk
+
+  def iter_chunks(self, chunk_size=DARC_CHUNK_SIZE):
+    # Yields the entry's data in pieces of up to chunk_size bytes
+    size = self.get_size()
+    if not self.is_lazy():
+      data = memoryview(self.data)
+      for offset in range(0, size, chunk_size):
+        yield data[offset:offset + chunk_size]
+      return
+    with self.open_reader() as read:
+      for offset in range(0, size, chunk_size):
+        yield self.read_chunk(offset, min(chunk_size, size - offset), read)
 
 class DarcGroup:
   def __init__(self, name=''):
@@ -21,10 +116,23 @@ class DarcGroup:
     self.entries.append(entry)
     return entry
 
+  def add_lazy_entry(self, name, size, read):
+    entry = DarcEntry(name=name, data=None, size=size, read=read)
+    self.entries.append(entry)
+    return entry
+
+  def add_file_entry(self, name, path):
+    # The file is only read when the archive is written
+    source = FileSource(path)
+    return self.add_lazy_entry(name, source.size, source)
+
 class Darc:
   def __init__(self):
     self.root = DarcGroup()
     self.endian = '<'
+    self.index = {}
+    self.view = None
+    self.mapping = None
 
   @classmethod
   def Open(cls, path):
@@ -32,112 +140,205 @@ class Darc:
     with open(path, 'rb') as f:
       darc.read(f)
     return darc
-  
-  def save(self, path):
-    with open(path, 'wb') as f:
-      f.write(self.write())
-
-  def read_label(self, buffer, offset):
-    cur = buffer.tell()
-    buffer.seek(offset)
-    result = bytes()
-    while True:
-      char = buffer.read(2)
-      if char != b'\x00\x00':
-        result += char
-      else:
-        buffer.seek(cur)
-        return result.decode('UTF-16' + 'LE' if self.endian == '<' else 'BE')
 
-  def read(self, buffer):
-    magic, byte_order_mark = struct.unpack('>4sH', buffer.read(6))
+  @classmethod
+  def open_mapped(cls, path):
+    # Memory-maps the archive and only parses the header + entry table
+    # Entry data is returned as memoryview slices of the file, so it's only read from disk when accessed
+    darc = cls()
+    with open(path, 'rb') as f:
+      darc.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    darc.parse(darc.mapping)
+    return darc
+
+  @classmethod
+  def from_bytes(cls, data):
+    darc = cls()
+    darc.parse(data)
+    return darc
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    # Any entry data views must be released before the mapping can be closed
+    self.index = {}
+    self.root = DarcGroup()
+    if self.view is not None:
+      self.view.release()
+      self.view = None
+    if self.mapping is not None:
+      self.mapping.close()
+      self.mapping = None
+
+  def save(self, path, little_endian=True, chunk_size=DARC_CHUNK_SIZE):
+    # Streams the archive to a file, the layout only depends on entry sizes so data is written in chunks as it's read
+    # That way only one chunk of entry data needs to be in memory at a time, no matter how large the archive is
+    self.endian = '<' if little_endian else '>'
+    layout = self.get_layout()
+    header = bytearray(layout.data_offset)
+    self.write_table(layout, header, 0)
+    with open(str(path), 'wb') as f:
+      f.write(header)
+      pos = layout.data_offset
+      for i, entry in enumerate(layout.entries):
+        f.write(bytes(layout.data_offsets[i] - pos))
+        for chunk in entry.iter_chunks(chunk_size):
+          f.write(chunk)
+        pos = layout.data_offsets[i] + entry.get_size()
+    return layout.size
+
+  def get(self, name):
+    offset, size = self.index[name]
+    return self.view[offset:offset + size]
+
+  def read_label(self, labels, offset):
+    # labels are null-terminated UTF-16, so look for a 2-byte aligned 0x0000
+    end = labels.find(b'\x00\x00', offset)
+    while end != -1 and (end - offset) % 2:
+      end = labels.find(b'\x00\x00', end + 1)
+    if end == -1:
+      end = len(labels)
+    return labels[offset:end].decode('UTF-16LE' if self.endian == '<' else 'UTF-16BE')
+
+  def read_header(self, header):
+    magic, byte_order_mark = struct.unpack_from('>4sH', header, 0)
+    if magic != b'darc':
+      raise ValueError('Invalid DARC magic')
     self.endian = '<' if byte_order_mark == 0xFFFE else '>'
-    header_size, version, darc_size = struct.unpack('%sH2I'%self.endian, buffer.read(10))
-    table_offset, table_size, data_offset = struct.unpack('%s3I'%self.endian, buffer.read(12))
-
-    total_entries = 0
-    entry_index = 0
-    while True:
-      buffer.seek(table_offset + entry_index * 12)
-      label_offset, entry_offset, entry_size = struct.unpack('%s3I'%self.endian, buffer.read(12))
+    header_size, version, darc_size = struct.unpack_from('%sH2I'%self.endian, header, 6)
+    table_offset, table_size, data_offset = struct.unpack_from('%s3I'%self.endian, header, 16)
+    return table_offset, table_size
+
+  def read_table(self, table):
+    # Returns a (name, offset, size) tuple for each file entry
+    # the first node is the root node, its size field is the total number of entries
+    total_entries = struct.unpack_from('%s3I'%self.endian, table, 0)[2]
+    nodes = struct.unpack_from('%s%dI'%(self.endian, total_entries * 3), table, 0)
+    labels = bytes(table[total_entries * 12:])
+    self.root = DarcGroup()
+    entries = []
+    for i in range(0, total_entries * 3, 3):
+      label_offset, entry_offset, entry_size = nodes[i:i + 3]
       # upper 16 bits indicates whether this is for a folder entry
       is_folder = label_offset & 0xFF000000
       label_offset &= 0x00FFFFFF
       # if folder entry (there doesnt seem to be subfolders, just a single root folder)
       if is_folder:
-        # get entry count from root node 
-        if label_offset == 0:
-          self.root = DarcGroup()
-          total_entries = entry_size
-        # get root node label 
-        else:
-          self.root.name = self.read_label(buffer, (table_offset + total_entries * 12) + label_offset)
+        # get root node label
+        if label_offset != 0:
+          self.root.name = self.read_label(labels, label_offset)
       # if normal entry
       else:
-        entry = self.root.add_entry()
-        buffer.seek(entry_offset)
-        entry.data = buffer.read(entry_size)
-        entry.name = self.read_label(buffer, (table_offset + total_entries * 12) + label_offset)
-      
-      entry_index += 1
-      if entry_index >= total_entries:
-        break
+        entries.append((self.read_label(labels, label_offset), entry_offset, entry_size))
+    return entries
+
+  def read(self, buffer):
+    table_offset, table_size = self.read_header(buffer.read(28))
+    buffer.seek(table_offset)
+    for name, offset, size in self.read_table(buffer.read(table_size)):
+      buffer.seek(offset)
+      self.root.add_entry(name=name, data=buffer.read(size))
+
+  def parse(self, data):
+    # Reads an archive from any bytes-like object, without copying entry data
+    self.view = memoryview(data)
+    table_offset, table_size = self.read_header(self.view[:28])
+    self.index = {}
+    for name, offset, size in self.read_table(self.view[table_offset:table_offset + table_size]):
+      if offset + size > len(self.view):
+        raise ValueError('DARC entry %s is out of bounds' % name)
+      self.index[name] = (offset, size)
+      self.root.add_entry(name=name, data=self.view[offset:offset + size])
 
   def write_label(self, label):
-    return label.encode('UTF-16' + 'LE' if self.endian == '<' else 'BE') + bytes(2)
-      
+    return label.encode('UTF-16LE' if self.endian == '<' else 'UTF-16BE') + bytes(2)
+
+  def get_layout(self):
+    layout = DarcLayout()
+    # entries are sorted by alphabetical order
+    layout.entries = sorted(self.root.entries, key=lambda entry: entry.name)
+    layout.labels = [self.write_label(entry.name) for entry in layout.entries]
+    # label data always begins with 2 empty bytes, followed by the root label which is always '.'
+    label_offset = 2 + len(self.write_label('.'))
+    for label in layout.labels:
+      layout.label_offsets.append(label_offset)
+      label_offset += len(label)
+    # root node + root label node + entries
+    layout.num_entries = len(layout.entries) + 2
+    layout.table_size = (layout.num_entries * 12) + label_offset
+    # the label section is padded so that the data section aligns to a multiple of 0x80
+    layout.data_offset = align(28 + layout.table_size)
+    # each entry's data is also aligned to a multiple of 0x80
+    data_end = layout.data_offset
+    for entry in layout.entries:
+      data_offset = align(data_end)
+      layout.data_offsets.append(data_offset)
+      data_end = data_offset + entry.get_size()
+    layout.size = data_end
+    return layout
+
   def write(self, little_endian=True):
     self.endian = '<' if little_endian else '>'
-  
-    labels = bytes(2) # label data always begins with 2 empty bytes?
-    label_offsets = []
-    data = bytes()
-    data_offsets = []
-    # add root label, which is always '.'
-    labels += self.write_label('.')
-    # pack entry labels + data
-    num_entries = len(self.root.entries) + 2
-    # sort entries by alphabetical order
-    for entry in sorted(self.root.entries, key=lambda entry: entry.name): 
-      label_offsets.append(len(labels))
-      data_offset = len(data)
-      # align data offset to a multiple of 0x80
-      if data_offset % 0x80 != 0:
-        align = 0x80 - data_offset % 0x80
-        data += bytes(align)
-        data_offset += align
-      data_offsets.append(data_offset)
-      labels += self.write_label(entry.name)
-      data += entry.data
-
-    # add padding to the label section so that the data section aligns to a multiple of 0x80
-    table_size = (num_entries * 12) + len(labels)
-    base_data_offset = 28 + table_size
-    if base_data_offset % 0x80 != 0:
-      align = 0x80 - base_data_offset % 0x80
-      labels += bytes(align)
-      base_data_offset += align
-
-    # write entry table
-    table = bytes()
-    # add root node
-    table += struct.pack('%s3I'%self.endian, 0x01000000, 0, num_entries)
-    # add root label node
-    table += struct.pack('%s3I'%self.endian, 0x01000002, 0, num_entries)
-    # write entries
-    for i in range(num_entries - 2):
-      label_offset = label_offsets[i]
-      data_offset = base_data_offset + data_offsets[i]
-      data_size = len(self.root.entries[i].data)
-      # pack table entry
-      table += struct.pack('%s3I'%self.endian, label_offset, data_offset, data_size)
-
-    # write header
-    header = bytes()
+    layout = self.get_layout()
+    buffer = bytearray(layout.size)
+    self.write_layout(layout, buffer, 0)
+    return buffer
+
+  def write_into(self, buffer, offset=0, little_endian=True):
+    # Packs the archive straight into a larger writable buffer, returns the number of bytes written
+    self.endian = '<' if little_endian else '>'
+    layout = self.get_layout()
+    if offset + layout.size > len(buffer):
+      raise ValueError('Buffer is too small for DARC archive (%d bytes needed)' % layout.size)
+    self.write_layout(layout, buffer, offset)
+    return layout.size
+
+  def write_layout(self, layout, buffer, offset):
+    view = memoryview(buffer)
+    pos = self.write_table(layout, buffer, offset)
+
+    # write entry data
+    for i, entry in enumerate(layout.entries):
+      data_offset = offset + layout.data_offsets[i]
+      view[pos:data_offset] = bytes(data_offset - pos)
+      pos = data_offset + entry.get_size()
+      if entry.is_lazy():
+        for chunk in entry.iter_chunks():
+          view[data_offset:data_offset + len(chunk)] = chunk
+          data_offset += len(chunk)
+      else:
+        view[data_offset:pos] = entry.data
+
+  def write_table(self, layout, buffer, offset):
+    # Writes everything before the data section, returns the position where the data section starts
+    view = memoryview(buffer)
+    num_entries = layout.num_entries
     # pack magic + byte order mark
-    header += struct.pack('>4sH', b'darc', 0xFFFE if little_endian else 0xFEFF)
+    struct.pack_into('>4sH', buffer, offset, b'darc', 0xFFFE if self.endian == '<' else 0xFEFF)
     # pack headersize, version, filesize
-    header += struct.pack('%sH2I'%self.endian, 28, 16777216, base_data_offset + len(data))
-    # pack table offset, table size, data offset
-    header += struct.pack('%s3I'%self.endian, 28, table_size, base_data_offset)
-    return header + table + labels + data
\ No newline at end of file
+    # then table offset, table size, data offset
+    struct.pack_into('%sH5I'%self.endian, buffer, offset + 6, 28, 16777216, layout.size, 28, layout.table_size, layout.data_offset)
+
+    # write entry table - root node and root label node come first
+    table = [0x01000000, 0, num_entries, 0x01000002, 0, num_entries]
+    for i, entry in enumerate(layout.entries):
+      table += [layout.label_offsets[i], layout.data_offsets[i], entry.get_size()]
+    struct.pack_into('%s%dI'%(self.endian, len(table)), buffer, offset + 28, *table)
+
+    # write labels
+    pos = offset + 28 + num_entries * 12
+    root_label = bytes(2) + self.write_label('.')
+    view[pos:pos + len(root_label)] = root_label
+    pos += len(root_label)
+    for label in layout.labels:
+      view[pos:pos + len(label)] = label
+      pos += len(label)
+
+    # alignment padding is zeroed explicitly in case the buffer isn't already empty
+    data_offset = offset + layout.data_offset
+    view[pos:data_offset] = bytes(data_offset - pos)
+    return data_offset
@@ -1,62 +1,320 @@
 # IPS lib
 # Allows .ips patch files to be generated without needing the target file, as long as you know your target offsets
+# Also supports the IPS32 variant ("IPS32" header, 4-byte offsets and an "EEOF" marker) for targets over 16 MiB
 # Written by Jaames
 # github.com/jaames | jamesdaniel.dev
 
+import mmap
+import os
+import re
+import shutil
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+IPS_MAX_OFFSET = 0xFFFFFF
+IPS32_MAX_OFFSET = 0xFFFFFFFF
+IPS_MAX_SIZE = 0xFFFF
+# A record can't start at this offset, since it would be read as the "EOF" marker
+IPS_EOF_OFFSET = 0x454F46
+IPS32_EOF_OFFSET = 0x45454F46
+# Encoded record sizes - offset + size + data for literal records, offset + zero size + count + value for RLE records
+IPS_RECORD_SIZE = 5
+IPS_RLE_RECORD_SIZE = 8
+# Chunk sizes used when comparing files without numpy
+DIFF_CHUNK_SIZE = 0x10000
+DIFF_MIN_CHUNK_SIZE = 0x40
+# Runs of repeated bytes shorter than this are never cheaper to RLE encode than to include in a literal record
+RLE_MIN_RUN = 4
+CHANGED_PATTERN = re.compile(b'[^\\x00]+')
+REPEATED_RUN_PATTERN = re.compile(b'(.)\\1{%d,}' % (RLE_MIN_RUN - 1), re.DOTALL)
+
+def find_diff_ranges(original, modified):
+  # Returns (start, end) ranges where two equal-length buffers differ
+  if numpy is not None:
+    a = numpy.frombuffer(original, dtype=numpy.uint8)
+    b = numpy.frombuffer(modified, dtype=numpy.uint8)
+    changed = numpy.concatenate(([False], a != b, [False]))
+    # edges are where a run of changed bytes starts or ends
+    edges = numpy.flatnonzero(changed[1:] != changed[:-1]).tolist()
+    return list(zip(edges[0::2], edges[1::2]))
+  ranges = []
+  size = len(original)
+  for start in range(0, size, DIFF_CHUNK_SIZE):
+    find_diff_chunk(original, modified, start, min(start + DIFF_CHUNK_SIZE, size), ranges)
+  return ranges
+
+def find_diff_chunk(original, modified, start, end, ranges):
+  # Compare whole chunks at C speed, and only narrow down the ones that differ
+  if original[start:end] == modified[start:end]:
+    return
+  if end - start > DIFF_MIN_CHUNK_SIZE:
+    middle = (start + end) // 2
+    find_diff_chunk(original, modified, start, middle, ranges)
+    find_diff_chunk(original, modified, middle, end, ranges)
+    return
+  # XOR the chunks as big integers, so that changed bytes are the non-zero ones, then let the regex engine find them
+  changed = (int.from_bytes(original[start:end], 'big') ^ int.from_bytes(modified[start:end], 'big')).to_bytes(end - start, 'big')
+  for match in CHANGED_PATTERN.finditer(changed):
+    # join up with the previous range if it ended right before this one
+    if ranges and ranges[-1][1] == start + match.start():
+      ranges[-1] = (ranges[-1][0], start + match.end())
+    else:
+      ranges.append((start + match.start(), start + match.end()))
+
+def find_repeated_runs(data):
+  # Returns (start, size) for every run of at least RLE_MIN_RUN repeated bytes
+  if numpy is not None:
+    a = numpy.frombuffer(data, dtype=numpy.uint8)
+    # runs start at 0 and wherever a byte differs from the one before it
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(a)) + 1))
+    sizes = numpy.diff(numpy.concatenate((starts, [len(a)])))
+    long_runs = sizes >= RLE_MIN_RUN
+    return list(zip(starts[long_runs].tolist(), sizes[long_runs].tolist()))
+  # the regex engine scans for repeated bytes at C speed
+  return [(match.start(), match.end() - match.start()) for match in REPEATED_RUN_PATTERN.finditer(data)]
+
 class IpsRecord:
-  def __init__(self, offset=0, data=bytes(0)):
+  def __init__(self, offset=0, data=bytes(0), rle=None):
     self.offset = offset
     self.data = data
+    # None lets the writer decide whether the record should be RLE encoded
+    self.rle = rle
+
+  def is_rle(self):
+    if self.rle is not None:
+      return self.rle
+    data = self.data
+    # if all bytes are the same
+    return len(data) > 3 and data.count(data[0]) == len(data)
 
 class IpsPatch:
-  def __init__(self):
+  def __init__(self, ips32=False):
     self.records = []
+    self.ips32 = ips32
 
-  def add_record(self, offset=0, data=bytes(0)):
-    record = IpsRecord(offset, data)
+  def get_format(self):
+    # Returns the header, footer, offset size, max offset and EOF offset for the patch format
+    if self.ips32:
+      return b'IPS32', b'EEOF', 4, IPS32_MAX_OFFSET, IPS32_EOF_OFFSET
+    return b'PATCH', b'EOF', 3, IPS_MAX_OFFSET, IPS_EOF_OFFSET
+
+  @classmethod
+  def from_diff(cls, original, modified):
+    # Creates an optimized patch that turns original into modified
+    # Both should be bytes-like, modified can't be smaller than original since IPS can't truncate files
+    if len(modified) < len(original):
+      raise ValueError('IPS patches can\'t make files smaller')
+    original = bytes(original)
+    modified = bytes(modified)
+    patch = cls(ips32=len(modified) > IPS_MAX_OFFSET + 1)
+    ranges = find_diff_ranges(original, modified[:len(original)])
+    # anything past the end of the original file is always included
+    if len(modified) > len(original):
+      ranges.append((len(original), len(modified)))
+    # unchanged gaps smaller than a record header are cheaper to include than to skip
+    merged = []
+    for start, end in ranges:
+      if merged and start - merged[-1][1] < IPS_RECORD_SIZE:
+        merged[-1] = (merged[-1][0], end)
+      else:
+        merged.append((start, end))
+    # a record can't start at the EOF marker's offset, so one starting there also takes the unchanged byte before it
+    eof_offset = patch.get_format()[4]
+    for start, end in merged:
+      if start == eof_offset:
+        start -= 1
+      patch.add_record(start, modified[start:end])
+    return patch.optimize()
+
+  def add_record(self, offset=0, data=bytes(0), rle=None):
+    record = IpsRecord(offset, data, rle)
     self.records.append(record)
+    return record
+
+  def merge_records(self):
+    # Sorts records and merges any that are adjacent or overlapping into contiguous (offset, data) blocks
+    blocks = []
+    for record in sorted(self.records, key=lambda record: record.offset):
+      if len(record.data) == 0:
+        continue
+      if blocks:
+        offset, data = blocks[-1]
+        end = offset + len(data)
+        if record.offset <= end:
+          # overlapping bytes have to agree, otherwise the patch result would depend on record order
+          overlap = data[record.offset - offset:]
+          if record.data[:len(overlap)] != overlap[:len(record.data)]:
+            raise ValueError('Conflicting IPS records overlap at offset 0x%06x' % record.offset)
+          data += record.data[len(overlap):]
+          continue
+      blocks.append((record.offset, bytearray(record.data)))
+    return blocks
+
+  def split_block(self, offset, data):
+    # Splits a contiguous block into a minimal set of literal and RLE runs
+    # Returns a list of (offset, size, rle) runs
+    # Only the boundaries between runs of repeated bytes need to be considered as split points,
+    # since an RLE record costs the same no matter how many bytes it covers
+    # Runs shorter than RLE_MIN_RUN always end up in a literal, so the bytes between longer runs are treated as a single literal-only run
+    data = bytes(data)
+    runs = []
+    pos = 0
+    for start, size in find_repeated_runs(data):
+      if start > pos:
+        runs.append((pos, start - pos, False))
+      runs.append((start, size, True))
+      pos = start + size
+    if pos < len(data):
+      runs.append((pos, len(data) - pos, False))
+
+    # closed[i] is the smallest encoding of everything before run i, with no record left open
+    # literal[i] is the smallest encoding up to the end of run i, with a literal record still open
+    # literals longer than 0xFFFF bytes also pay for extra record headers, which this doesn't account for
+    closed = [0]
+    literal = []
+    literal_continues = []
+    closed_by_rle = []
+    for i, (start, size, repeated) in enumerate(runs):
+      if i > 0 and literal[i - 1] <= closed[i] + IPS_RECORD_SIZE:
+        literal.append(literal[i - 1] + size)
+        literal_continues.append(True)
+      else:
+        literal.append(closed[i] + IPS_RECORD_SIZE + size)
+        literal_continues.append(False)
+      rle_cost = closed[i] + IPS_RLE_RECORD_SIZE * -(-size // IPS_MAX_SIZE)
+      if repeated and rle_cost < literal[i]:
+        closed.append(rle_cost)
+        closed_by_rle.append(True)
+      else:
+        closed.append(literal[i])
+        closed_by_rle.append(False)
+
+    # walk back through the choices to find the runs
+    segments = []
+    i = len(runs) - 1
+    while i >= 0:
+      start, size, repeated = runs[i]
+      if closed_by_rle[i]:
+        segments.append((start, size, True))
+        i -= 1
+      else:
+        end = start + size
+        while literal_continues[i]:
+          i -= 1
+        segments.append((runs[i][0], end - runs[i][0], False))
+        i -= 1
+    segments.reverse()
+
+    # split anything that's too large for a single record
+    result = []
+    for start, size, rle in segments:
+      while size > 0:
+        chunk = min(size, IPS_MAX_SIZE)
+        result.append((offset + start, chunk, rle))
+        start += chunk
+        size -= chunk
+    return result
+
+  def optimize(self):
+    # Rewrites the patch's records into the smallest equivalent set of records
+    # - records are sorted, and adjacent or overlapping records are merged
+    # - merged blocks are split into literal and RLE runs, whichever encodes smallest
+    # - records larger than 0xFFFF bytes are split up
+    header, footer, offset_size, max_offset, eof_offset = self.get_format()
+    records = []
+    for offset, data in self.merge_records():
+      base = offset
+      for run_offset, size, rle in self.split_block(offset, data):
+        run_data = bytes(data[run_offset - base:run_offset - base + size])
+        if run_offset == eof_offset:
+          # move the first byte into the previous record, if it ends right here
+          previous = records[-1] if records else None
+          if previous is None or previous.offset + len(previous.data) != run_offset or len(previous.data) >= IPS_MAX_SIZE:
+            raise ValueError('IPS records can\'t start at offset 0x%06x' % eof_offset)
+          previous.data += run_data[:1]
+          previous.rle = previous.rle and previous.data[0] == run_data[0]
+          run_offset += 1
+          run_data = run_data[1:]
+          if not run_data:
+            continue
+        if run_offset > max_offset:
+          raise ValueError('IPS record at offset 0x%06x is out of range' % run_offset)
+        records.append(IpsRecord(run_offset, run_data, rle))
+    self.records = records
+    return self
 
   def write(self):
-    # Write "PATCH" header
-    result = b'PATCH'
+    header, footer, offset_size, max_offset, eof_offset = self.get_format()
+    # Write "PATCH" (or "IPS32") header
+    result = bytearray(header)
     # Write records
     for record in self.records:
-      result += record.offset.to_bytes(3, byteorder='big')
+      if record.offset > max_offset:
+        raise ValueError('IPS record at offset 0x%06x is out of range, use IPS32 instead' % record.offset)
+      result += record.offset.to_bytes(offset_size, byteorder='big')
       data = record.data
 
-      # if all bytes are the same
-      if len(data) > 3 and all(byte == data[0] for byte in data):
-        result += bytes(2) 
+      if record.is_rle():
+        result += bytes(2)
         result += len(data).to_bytes(2, byteorder='big')
-        result += bytes([data[0]])
-      
+        result.append(data[0])
+
       else:
-        result += len(record.data).to_bytes(2, byteorder='big')
-        result += record.data
-    # Write "EOF" end of file marker
-    result += b'EOF'
-    return result
+        result += len(data).to_bytes(2, byteorder='big')
+        result += data
+    # Write "EOF" (or "EEOF") end of file marker
+    result += footer
+    return bytes(result)
 
   def read(self, buffer):
-    header = buffer.read(5)
-    while True:
-      chunk = buffer.read(3)
+    self.parse(buffer.read())
 
+  def parse(self, data):
+    view = memoryview(data)
+    self.ips32 = bytes(view[:5]) == b'IPS32'
+    header, footer, offset_size, max_offset, eof_offset = self.get_format()
+    if bytes(view[:5]) != header:
+      raise ValueError('Invalid IPS header')
+    pos = 5
+    while pos < len(view):
       # Break loop if end of file ("EOF") marker is reached
-      if chunk == b'EOF':
-        break;
+      if bytes(view[pos:pos + len(footer)]) == footer:
+        break
 
-      record_offset = int.from_bytes(chunk, byteorder='big')
-      record_size = int.from_bytes(buffer.read(2), byteorder='big')
+      record_offset = int.from_bytes(view[pos:pos + offset_size], byteorder='big')
+      record_size = int.from_bytes(view[pos + offset_size:pos + offset_size + 2], byteorder='big')
+      pos += offset_size + 2
 
       # RLE entry
       if record_size == 0:
-        count = int.from_bytes(buffer.read(2), byteorder='big')
-        value = int.from_bytes(buffer.read(1), byteorder='big')
-        self.add_record(offset=record_offset, data=bytes([value] * count))
+        count = int.from_bytes(view[pos:pos + 2], byteorder='big')
+        self.add_record(offset=record_offset, data=bytes(view[pos + 2:pos + 3]) * count, rle=True)
+        pos += 3
 
-      else: 
-        self.add_record(offset=record_offset, data=buffer.read(record_size))
+      else:
+        self.add_record(offset=record_offset, data=bytes(view[pos:pos + record_size]), rle=False)
+        pos += record_size
+
+  def apply(self, target_path, out_path=None):
+    # Applies the patch to a file in place, or to a copy of it if out_path is given
+    # The file is memory-mapped so only the pages touched by records are read and written
+    if out_path is not None:
+      shutil.copyfile(str(target_path), str(out_path))
+      target_path = out_path
+    if not self.records:
+      return target_path
+    patched_size = max(record.offset + len(record.data) for record in self.records)
+    with open(str(target_path), 'r+b') as f:
+      # records past the end of the file extend it
+      if patched_size > os.fstat(f.fileno()).st_size:
+        f.truncate(patched_size)
+      with mmap.mmap(f.fileno(), 0) as target:
+        for record in self.records:
+          target[record.offset:record.offset + len(record.data)] = record.data
+    return target_path
 
   def save(self, path):
     with open(path, 'wb') as buffer:
@@ -73,4 +331,21 @@ class IpsPatch:
     with open(path, 'rb') as buffer:
       patch = IpsPatch()
       patch.read(buffer)
-    return patch
\ No newline at end of file
+    return patch
+
+if __name__ == '__main__':
+  from sys import argv
+
+  # usage: ips.py apply <patch> <target> [output]
+  #        ips.py diff <original> <modified> <patch>
+  if argv[1] == 'apply':
+    patch = IpsPatch.Open(argv[2])
+    patch.apply(argv[3], argv[4] if len(argv) > 4 else None)
+  elif argv[1] == 'diff':
+    with open(argv[2], 'rb') as f:
+      original = f.read()
+    with open(argv[3], 'rb') as f:
+      modified = f.read()
+    IpsPatch.from_diff(original, modified).save(argv[4])
+  else:
+    exit('Unknown command %s, use apply or diff' % argv[1])
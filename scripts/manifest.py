@@ -0,0 +1,62 @@
+# Output manifest lib
+# Lists every file in a build output folder along with its size and a hash of its contents
+# Used to work out which files need to be copied when deploying to an SD card
+
+import hashlib
+import json
+import os
+import pathlib
+
+MANIFEST_NAME = 'fs3d_manifest.json'
+MANIFEST_TMP_NAME = 'fs3d_manifest.tmp'
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 0x100000
+
+def hash_file(path):
+  # blake2b is faster than sha1 on 64-bit machines, and 16 bytes is plenty to spot changed files
+  digest = hashlib.blake2b(digest_size=16)
+  with open(str(path), 'rb') as f:
+    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def load_manifest(root_path):
+  # Returns the manifest's {path: entry} dict, or an empty one if there's no valid manifest
+  try:
+    with (pathlib.Path(root_path) / MANIFEST_NAME).open('r') as fp:
+      manifest = json.loads(fp.read())
+  except (OSError, ValueError):
+    return {}
+  if manifest.get('version') != MANIFEST_VERSION:
+    return {}
+  return manifest.get('files', {})
+
+def save_manifest(root_path, files):
+  manifest_path = pathlib.Path(root_path) / MANIFEST_NAME
+  tmp_path = manifest_path.with_name(MANIFEST_TMP_NAME)
+  with tmp_path.open('w') as fp:
+    fp.write(json.dumps({'version': MANIFEST_VERSION, 'files': files}, indent=2, sort_keys=True))
+  os.replace(str(tmp_path), str(manifest_path))
+
+def make_manifest(root_path, previous=None):
+  # Paths are relative to the root folder and always use forward slashes
+  # Files whose size and mtime match the previous manifest keep their hash instead of being read again
+  previous = previous or {}
+  root_path = pathlib.Path(root_path)
+  files = {}
+  for path in sorted(root_path.rglob('*')):
+    if not path.is_file() or path.parent == root_path and path.name in (MANIFEST_NAME, MANIFEST_TMP_NAME):
+      continue
+    name = path.relative_to(root_path).as_posix()
+    stat = path.stat()
+    entry = previous.get(name)
+    if entry is None or entry['size'] != stat.st_size or entry.get('mtime') != stat.st_mtime_ns:
+      entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': hash_file(path)}
+    files[name] = entry
+  return files
+
+def update_manifest(root_path):
+  # Writes a fresh manifest for a build output folder
+  files = make_manifest(root_path, load_manifest(root_path))
+  save_manifest(root_path, files)
+  return files
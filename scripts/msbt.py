@@ -68,10 +68,21 @@ class Msbt:
     return msbt
 
   @classmethod
-  def from_json(cls, path):
+  def from_bytes(cls, data):
     msbt = cls()
+    msbt.parse(data)
+    return msbt
+
+  @classmethod
+  def from_json(cls, path):
     with open(path, 'r') as fp:
-      data = json.loads(fp.read())
+      return cls.from_json_data(fp.read())
+
+  @classmethod
+  def from_json_data(cls, text):
+    # Takes the contents of a .msbt.json file, either as a string or as UTF-8 bytes
+    msbt = cls()
+    data = json.loads(text)
     for group in data['groups']:
       msbt_group = msbt.add_group()
       for entry in group:
@@ -80,71 +91,69 @@ class Msbt:
         msbt_entry.text = entry['text']
     return msbt
 
-  def save(self, path):
+  def save(self, path, pool_strings=False):
     with open(path, 'wb') as fp:
-      fp.write(self.write())
+      fp.write(self.write(pool_strings=pool_strings))
 
   def add_group(self):
     group = MsbtGroup()
     self.groups.append(group)
     return group
 
-  def read_string(self, buffer, offset):
-    cur = buffer.tell()
-    buffer.seek(offset)
-    result = bytes()
-    while True:
-      char = buffer.read(2)
-      if char != b'\x00\x00':
-        result += char
-      else:
-        buffer.seek(cur)
-        return result.decode('UTF-16' + 'LE' if self.endian == '<' else 'BE')
-  
   def read(self, buffer):
-    magic, byte_order_mark = struct.unpack('>8sH', buffer.read(10))
+    self.parse(buffer.read())
+
+  def parse(self, data):
+    # Parses the whole file from a single buffer without copying it
+    view = memoryview(data)
+    magic, byte_order_mark = struct.unpack_from('>8sH', view, 0)
     if magic != MAGIC:
-      print('invalid MSBT magic')
-      exit()
+      raise ValueError('Invalid MSBT magic')
 
     self.endian = '<' if byte_order_mark == 0xFFFE else '>'
-    unknown1, unknown2, num_sections, unknown3, filesize = struct.unpack('%s4HI'%self.endian, buffer.read(12))
-
-    buffer.seek(10, 1) # skip padding (?)
+    encoding = 'UTF-16LE' if self.endian == '<' else 'UTF-16BE'
+    unknown1, unknown2, num_sections, unknown3, filesize = struct.unpack_from('%s4HI'%self.endian, view, 10)
 
-    lbl1_offset = 0
-    atr1_offset = 0
-    txt2_offset = 0
+    # skip padding (?)
+    offset = 32
 
+    sections = {}
     for i in range(num_sections):
-      magic, size, _ = struct.unpack('%s4sI8s'%self.endian, buffer.read(16))
-      padded_size = size + (0x10 - (size % 0x10)) if size % 0x10 != 0 else size 
-      if magic == b'LBL1':   lbl1_offset = buffer.tell()
-      elif magic == b'ATR1': atr1_offset = buffer.tell()
-      elif magic == b'TXT2': txt2_offset = buffer.tell()
-      buffer.seek(padded_size, 1)
+      magic, size = struct.unpack_from('%s4sI'%self.endian, view, offset)
+      sections[magic] = (offset + 16, size)
+      padded_size = size + (0x10 - (size % 0x10)) if size % 0x10 != 0 else size
+      offset += 16 + padded_size
 
+    # every string runs from its own offset up to the next one, the last string ends with the section
+    txt2_offset, txt2_size = sections[b'TXT2']
+    num_strings = struct.unpack_from('%sI'%self.endian, view, txt2_offset)[0]
+    string_offsets = struct.unpack_from('%s%dI'%(self.endian, num_strings), view, txt2_offset + 4) + (txt2_size,)
     strings = []
-    buffer.seek(txt2_offset)
-    num_strings = struct.unpack('%sI'%self.endian, buffer.read(4))[0]
     for i in range(num_strings):
-      offset = struct.unpack('%sI'%self.endian, buffer.read(4))[0]
-      strings.append(self.read_string(buffer, txt2_offset + offset))
+      start = txt2_offset + string_offsets[i]
+      end = txt2_offset + string_offsets[i + 1]
+      # strip the null terminator
+      if end - start >= 2 and view[end - 2:end] == b'\x00\x00':
+        end -= 2
+      strings.append(str(view[start:end], encoding))
 
-    buffer.seek(lbl1_offset)
-    num_groups = struct.unpack('%sI'%self.endian, buffer.read(4))[0]
-    groups = [struct.unpack('%s2I'%self.endian, buffer.read(8)) for i in range(num_groups)]
-    for num_labels, offset in groups:
+    lbl1_offset = sections[b'LBL1'][0]
+    num_groups = struct.unpack_from('%sI'%self.endian, view, lbl1_offset)[0]
+    groups = struct.unpack_from('%s%dI'%(self.endian, num_groups * 2), view, lbl1_offset + 4)
+    index_format = struct.Struct('%sI'%self.endian)
+    for i in range(0, num_groups * 2, 2):
+      num_labels, offset = groups[i:i + 2]
       group = self.add_group()
-      buffer.seek(lbl1_offset + offset)
-      for i in range(num_labels):
-        entry = group.add_entry()
+      offset += lbl1_offset
+      for j in range(num_labels):
         # read label
-        label_size = ord(buffer.read(1))
-        entry.label = buffer.read(label_size).decode('ascii')
+        label_size = view[offset]
+        label = str(view[offset + 1:offset + 1 + label_size], 'ascii')
+        offset += 1 + label_size
         # get string index
-        string_index = struct.unpack('%sI'%self.endian, buffer.read(4))[0]
-        entry.text = strings[string_index]
+        string_index = index_format.unpack_from(view, offset)[0]
+        offset += 4
+        group.add_entry(label, strings[string_index])
 
   def dump_json(self, path):
     msbt_json = {
@@ -161,76 +170,99 @@ class Msbt:
     with open(path, 'w') as fp:
       fp.write(json.dumps(msbt_json, ensure_ascii=False, indent=2, sort_keys=True))
 
-  def write(self, little_endian=True):
+  def write(self, little_endian=True, pool_strings=False):
     self.endian = '<' if little_endian else '>'
+    encoding = 'UTF-16LE' if self.endian == '<' else 'UTF-16BE'
+    entries = [entry for group in self.groups for entry in group.entries]
 
-    # write txt2 section
-    txt2 = bytes()
-    strings = [entry.text for entry in sum([group.entries for group in self.groups], [])]
+    # By default every label gets its own string, in label order
+    # With string pooling, labels with identical text share a single string instead
+    if pool_strings:
+      pool = {}
+      string_indices = [pool.setdefault(entry.text, len(pool)) for entry in entries]
+      strings = [text.encode(encoding) for text in pool]
+    else:
+      string_indices = range(len(entries))
+      strings = [entry.text.encode(encoding) for entry in entries]
+    labels = [entry.label.encode('ascii') for entry in entries]
+
+    # work out section sizes up front
+    num_groups = len(self.groups)
     num_strings = len(strings)
-    # write number of strings
-    txt2 += struct.pack('%sI'%self.endian, num_strings)
-    # write string offsets
-    # string offset is relative to the start of the txt2 section
-    # so we account for the 4-byte num_strings and 4-byte offsets for each string
-    offset = 4 + (num_strings * 4)
-    for string in strings:
-      txt2 += struct.pack('%sI'%self.endian, offset)
-      # strings are 16-bits per char + 2 null bytes
-      offset += (len(string) * 2) + 2
-    # write strings
-    for string in strings:
-      txt2 += string.encode('UTF-16' + 'LE' if self.endian == '<' else 'BE')
-      txt2 += bytes(2)
-    txt2 = self.write_section(b'TXT2', txt2)
+    # group table + labels, each label is a size byte + label + 4-byte string index
+    lbl1_size = 4 + (num_groups * 8) + sum(len(label) + 5 for label in labels)
+    atr1_size = 8
+    # number of strings + string offsets + strings, each string is followed by 2 null bytes
+    txt2_size = 4 + (num_strings * 4) + sum(len(string) + 2 for string in strings)
 
-    # write atr1 section
-    num_non_empty_groups = 0
-    for group in self.groups:
-      if len(group.entries) > 0:
-        num_non_empty_groups += 1
-    atr1 = self.write_section(b'ATR1', struct.pack('%sII'%self.endian, num_non_empty_groups, 0))
+    lbl1_offset = 32
+    atr1_offset = lbl1_offset + self.section_size(lbl1_size)
+    txt2_offset = atr1_offset + self.section_size(atr1_size)
+    filesize = txt2_offset + self.section_size(txt2_size)
+    num_sections = 3
+
+    buffer = bytearray(filesize)
+    view = memoryview(buffer)
+
+    # write header
+    struct.pack_into('>8sH', buffer, 0, MAGIC, 0xFFFE if little_endian else 0xFEFF)
+    # pack unknown1, unknown2, num sections, unknown3, filesize
+    struct.pack_into('%s4HI'%self.endian, buffer, 10, 0, 769, num_sections, 0, filesize)
 
     # write lbl1 section
-    # write number of groups
-    lbl1 = bytes()
-    num_groups = len(self.groups)
-    lbl1 += struct.pack('%sI'%self.endian, num_groups)
-    label_data = bytes()
+    offset = self.write_section_header(buffer, lbl1_offset, b'LBL1', lbl1_size)
+    group_table = [num_groups]
     label_offset = 4 + (num_groups * 8)
-    string_index = 0
+    entry_index = 0
     for group in self.groups:
-      # write group
-      lbl1 += struct.pack('%sII'%self.endian, len(group.entries), label_offset)
-      # write group entries
+      group_table += [len(group.entries), label_offset]
       for entry in group.entries:
-        # write label size
-        label_size = len(entry.label)
-        label_data += bytes([label_size])
-        # write label
-        label_data += entry.label.encode('ascii')
-        # write string index
-        label_data += struct.pack('%sI'%self.endian, string_index)
-        label_offset += label_size + 5
-        string_index += 1
-    lbl1 += label_data
-    lbl1 = self.write_section(b'LBL1', lbl1)
-
-    filesize = 32 + len(lbl1) + len(atr1) + len(txt2)
-    num_sections = 3
-    # write header
-    header = bytes()
-    header += struct.pack('>8sH', MAGIC, 0xFFFE if little_endian else 0xFEFF)
-    # pack unknown1, unknown2, num sections, unknown3, filesize
-    header += struct.pack('%s4HI'%self.endian, 0, 769, num_sections, 0, filesize)
-    header += bytes(10)
-    return header + lbl1 + atr1 + txt2
-
-  def write_section(self, section_magic, section_data):
-    section_size = len(section_data)
-    header = struct.pack('%s4sI'%self.endian, section_magic, section_size) + bytes(8)
-    padding_size = (0x10 - (section_size % 0x10)) if section_size % 0x10 != 0 else 0
-    return header + section_data + bytes([0xAB] * padding_size)
+        label_offset += len(labels[entry_index]) + 5
+        entry_index += 1
+    struct.pack_into('%s%dI'%(self.endian, len(group_table)), buffer, offset, *group_table)
+    offset += len(group_table) * 4
+    index_format = struct.Struct('%sI'%self.endian)
+    for label, string_index in zip(labels, string_indices):
+      # write label size + label
+      buffer[offset] = len(label)
+      view[offset + 1:offset + 1 + len(label)] = label
+      offset += 1 + len(label)
+      # write string index
+      index_format.pack_into(buffer, offset, string_index)
+      offset += 4
+
+    # write atr1 section
+    num_non_empty_groups = sum(1 for group in self.groups if len(group.entries) > 0)
+    offset = self.write_section_header(buffer, atr1_offset, b'ATR1', atr1_size)
+    struct.pack_into('%sII'%self.endian, buffer, offset, num_non_empty_groups, 0)
+
+    # write txt2 section
+    offset = self.write_section_header(buffer, txt2_offset, b'TXT2', txt2_size)
+    # string offset is relative to the start of the txt2 section
+    # so we account for the 4-byte num_strings and 4-byte offsets for each string
+    string_table = [num_strings]
+    string_offset = 4 + (num_strings * 4)
+    for string in strings:
+      string_table.append(string_offset)
+      string_offset += len(string) + 2
+    struct.pack_into('%s%dI'%(self.endian, len(string_table)), buffer, offset, *string_table)
+    # write strings, the null terminators are already in place
+    for string, string_offset in zip(strings, string_table[1:]):
+      view[offset + string_offset:offset + string_offset + len(string)] = string
+
+    return bytes(buffer)
+
+  def section_size(self, size):
+    # section header + data, padded to a multiple of 0x10 bytes
+    return 16 + size + (-size % 0x10)
+
+  def write_section_header(self, buffer, offset, section_magic, section_size):
+    # writes the section header and the 0xAB padding after its data, returns the offset of the section data
+    struct.pack_into('%s4sI'%self.endian, buffer, offset, section_magic, section_size)
+    data_end = offset + 16 + section_size
+    padding_size = -section_size % 0x10
+    buffer[data_end:data_end + padding_size] = b'\xAB' * padding_size
+    return offset + 16
 
 if __name__ == '__main__':
   from sys import argv
@@ -0,0 +1,96 @@
+# Package writer lib
+# Writes build output straight into a .zip, .tar, .tar.gz or .tar.xz file from memory, instead of a loose folder
+# Files that are already compressed (like .blz archives) are stored as-is in zips, rather than being compressed twice
+
+import io
+import os
+import tarfile
+import time
+import zipfile
+
+# tar formats by file extension, and the mode they're opened with
+TAR_MODES = [
+  ('.tar.gz', 'w:gz'),
+  ('.tgz', 'w:gz'),
+  ('.tar.xz', 'w:xz'),
+  ('.tar', 'w'),
+]
+
+def get_package_mode(path):
+  # Returns 'zip' or the tarfile mode for a package path, or None if the format isn't supported
+  name = os.path.basename(str(path)).lower()
+  if name.endswith('.zip'):
+    return 'zip'
+  for suffix, mode in TAR_MODES:
+    if name.endswith(suffix):
+      return mode
+  return None
+
+class PackageWriter:
+  def __init__(self, path, level=6):
+    self.path = str(path)
+    self.level = level
+    self.mtime = time.time()
+    # Write to a temporary file first, so that a failed build doesn't leave a broken package behind
+    self.tmp_path = self.path + '.tmp'
+    self.zip = None
+    self.tar = None
+    mode = get_package_mode(self.path)
+    if mode is None:
+      raise ValueError('Unsupported package format %s, use .zip, .tar, .tar.gz or .tar.xz' % self.path)
+    if mode == 'zip':
+      self.zip = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=level)
+    elif mode == 'w:gz':
+      self.tar = tarfile.open(self.tmp_path, mode, compresslevel=level)
+    elif mode == 'w:xz':
+      self.tar = tarfile.open(self.tmp_path, mode, preset=level)
+    else:
+      self.tar = tarfile.open(self.tmp_path, mode)
+
+  @classmethod
+  def Open(cls, path, level=6):
+    return cls(path, level)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+  def add(self, name, data, compressed=False):
+    # Adds a file to the package, name should always use forward slashes
+    if self.zip is not None:
+      info = zipfile.ZipInfo(name, date_time=time.localtime(self.mtime)[:6])
+      info.external_attr = 0o644 << 16
+      # there's nothing to gain from deflating data that's already compressed
+      if compressed:
+        self.zip.writestr(info, data, compress_type=zipfile.ZIP_STORED)
+      else:
+        self.zip.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=self.level)
+    else:
+      # tar compresses the whole stream, so individual files can't be stored
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      info.mtime = int(self.mtime)
+      info.mode = 0o644
+      self.tar.addfile(info, io.BytesIO(data))
+
+  def close(self):
+    if self.zip is not None:
+      self.zip.close()
+    else:
+      self.tar.close()
+    os.replace(self.tmp_path, self.path)
+
+  def abort(self):
+    # Throws away everything written so far
+    try:
+      if self.zip is not None:
+        self.zip.close()
+      else:
+        self.tar.close()
+    finally:
+      os.remove(self.tmp_path)
@@ -0,0 +1,109 @@
+# Pipeline lib
+# Runs items through a chain of stages, each with its own worker threads, connected by bounded queues
+# Every stage works on a different item at the same time, so e.g. reading files overlaps with compressing,
+# and throughput is limited by the slowest stage rather than the sum of all of them
+# The queues are bounded, so a slow stage holds back the ones before it instead of letting items pile up in memory
+
+import queue
+import threading
+import time
+
+import scripts.profiler as Profiler
+
+# Marks the end of the items in a queue
+DONE = object()
+
+class Stage:
+  def __init__(self, name, func, workers=1):
+    self.name = name
+    self.func = func
+    self.workers = workers
+    self.items = 0
+    # seconds spent in func, and waiting for the next stage to have room, across all workers
+    self.busy = 0
+    self.blocked = 0
+    self.lock = threading.Lock()
+
+  def add_time(self, busy, blocked):
+    with self.lock:
+      self.items += 1
+      self.busy += busy
+      self.blocked += blocked
+
+class Pipeline:
+  def __init__(self, depth=4):
+    self.depth = depth
+    self.stages = []
+    self.error = None
+    self.elapsed = 0
+
+  def add_stage(self, name, func, workers=1):
+    # func takes an item and returns the item to pass on to the next stage
+    self.stages.append(Stage(name, func, max(workers, 1)))
+
+  def run(self, items):
+    # Returns the results of the last stage, in the order they finished
+    # If any stage raises, the remaining items are drained without being processed, and the first error is raised again here
+    queues = [queue.Queue(self.depth) for stage in self.stages] + [queue.Queue()]
+    threads = [threading.Thread(target=self.feed, args=(items, queues[0]), daemon=True)]
+    for i, stage in enumerate(self.stages):
+      remaining = [stage.workers]
+      for j in range(stage.workers):
+        threads.append(threading.Thread(target=self.work, args=(stage, queues[i], queues[i + 1], remaining), daemon=True))
+    start = time.perf_counter()
+    for thread in threads:
+      thread.start()
+    results = []
+    while True:
+      item = queues[-1].get()
+      if item is DONE:
+        break
+      results.append(item)
+    for thread in threads:
+      thread.join()
+    self.elapsed = time.perf_counter() - start
+    if self.error is not None:
+      raise self.error
+    return results
+
+  def feed(self, items, output):
+    for item in items:
+      if self.error is not None:
+        break
+      output.put(item)
+    output.put(DONE)
+
+  def work(self, stage, input, output, remaining):
+    while True:
+      item = input.get()
+      if item is DONE:
+        # Pass the marker on to the other workers in this stage, and to the next stage once they've all finished
+        input.put(DONE)
+        with stage.lock:
+          remaining[0] -= 1
+          last = remaining[0] == 0
+        if last:
+          output.put(DONE)
+        return
+      if self.error is not None:
+        continue
+      start = time.perf_counter()
+      try:
+        with Profiler.span(stage.name, 'pipeline'):
+          item = stage.func(item)
+      except BaseException as error:
+        self.error = self.error or error
+        continue
+      end = time.perf_counter()
+      output.put(item)
+      stage.add_time(end - start, time.perf_counter() - end)
+
+  def format_stats(self):
+    # Utilization is the share of the pipeline's run time that a stage's workers spent working
+    # The stage closest to 100% is the bottleneck, and stages that spend a lot of time blocked are waiting on a slower stage after them
+    lines = ['%-16s %8s %8s %12s %12s %8s' % ('stage', 'workers', 'items', 'busy (ms)', 'blocked (ms)', 'util')]
+    for stage in self.stages:
+      utilization = stage.busy / (self.elapsed * stage.workers) if self.elapsed else 0
+      lines.append('%-16s %8d %8d %12.2f %12.2f %7.1f%%' % (stage.name, stage.workers, stage.items, stage.busy * 1000, stage.blocked * 1000, utilization * 100))
+    lines.append('total %.2f ms with queue depth %d' % (self.elapsed * 1000, self.depth))
+    return '\n'.join(lines)
@@ -0,0 +1,144 @@
+# Build profiler lib
+# Records timed spans for each build phase, along with input and output byte counts
+# Results can be printed as a summary table, or saved as a Chrome trace event file (open it in chrome://tracing or ui.perfetto.dev)
+# Profiling is off by default, in which case span() returns a shared do-nothing span, so hooks can be left in place
+
+import json
+import os
+import threading
+import time
+
+class Span:
+  def __init__(self, profiler, name, category, args):
+    self.profiler = profiler
+    self.name = name
+    self.category = category
+    self.args = args
+    self.start = 0
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *args):
+    self.profiler.add_event(self.name, self.category, self.start, time.perf_counter(), self.args)
+
+  def set(self, **args):
+    self.args.update(args)
+
+class NullSpan:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def set(self, **args):
+    pass
+
+NULL_SPAN = NullSpan()
+
+class Profiler:
+  def __init__(self):
+    self.events = []
+    self.lock = threading.Lock()
+
+  def span(self, name, category='build', args={}):
+    return Span(self, name, category, dict(args))
+
+  def add_event(self, name, category, start, end, args):
+    # Events use the trace event format, with timestamps in microseconds
+    # perf_counter is system-wide, so events from worker processes line up with the main process
+    event = {
+      'name': name,
+      'cat': category,
+      'ph': 'X',
+      'ts': start * 1e6,
+      'dur': (end - start) * 1e6,
+      'pid': os.getpid(),
+      'tid': threading.get_ident(),
+      'args': args,
+    }
+    with self.lock:
+      self.events.append(event)
+
+  def merge(self, events):
+    with self.lock:
+      self.events += events
+
+  def get_totals(self):
+    # Returns {name: [count, seconds, bytes in, bytes out]} for every span name, in order of first appearance
+    totals = {}
+    for event in self.events:
+      total = totals.setdefault(event['name'], [0, 0, 0, 0])
+      total[0] += 1
+      total[1] += event['dur'] / 1e6
+      total[2] += event['args'].get('bytes_in', 0)
+      total[3] += event['args'].get('bytes_out', 0)
+    return totals
+
+  def format_summary(self):
+    # Times include any spans nested inside of them
+    lines = ['%-24s %8s %12s %12s %12s %8s' % ('phase', 'count', 'time (ms)', 'in (KiB)', 'out (KiB)', 'ratio')]
+    for name, (count, seconds, bytes_in, bytes_out) in self.get_totals().items():
+      lines.append('%-24s %8d %12.2f %12s %12s %8s' % (name, count, seconds * 1000, format_size(bytes_in), format_size(bytes_out), format_ratio(bytes_in, bytes_out)))
+    archives = sorted((event for event in self.events if event['name'] == 'archive'), key=lambda event: -event['dur'])
+    if archives:
+      lines.append('')
+      lines.append('%-72s %12s %12s %12s %8s' % ('archive', 'time (ms)', 'in (KiB)', 'out (KiB)', 'ratio'))
+      for event in archives:
+        args = event['args']
+        lines.append('%-72s %12.2f %12s %12s %8s' % (args.get('path', ''), event['dur'] / 1000, format_size(args.get('bytes_in', 0)), format_size(args.get('bytes_out', 0)), format_ratio(args.get('bytes_in', 0), args.get('bytes_out', 0))))
+    return '\n'.join(lines)
+
+  def save_trace(self, path):
+    events = list(self.events)
+    # name each process so the trace viewer can tell the main process apart from the workers
+    main_pid = os.getpid()
+    for pid in sorted(set(event['pid'] for event in self.events)):
+      events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'build' if pid == main_pid else 'worker %d' % pid}})
+    with open(str(path), 'w') as fp:
+      fp.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+def format_size(size):
+  return '%.1f' % (size / 1024) if size else '-'
+
+def format_ratio(bytes_in, bytes_out):
+  return '%.3f' % (bytes_out / bytes_in) if bytes_in and bytes_out else '-'
+
+# The active profiler, or None when profiling is disabled
+current = None
+
+def enable():
+  global current
+  current = Profiler()
+  return current
+
+def is_enabled():
+  return current is not None
+
+def span(name, category='build', **args):
+  if current is None:
+    return NULL_SPAN
+  return current.span(name, category, args)
+
+def event(name, start, category='build', **args):
+  # Records a span that started at start (a perf_counter time) and ends now, for work that isn't one block of code
+  if current is not None:
+    current.add_event(name, category, start, time.perf_counter(), args)
+
+def merge(events):
+  if current is not None:
+    current.merge(events)
+
+def call(enabled, func, *args):
+  # Runs a function in a worker process, with profiling enabled if it's enabled in the main process
+  # Returns the function's result along with any events recorded while it ran, which can be passed to merge()
+  global current
+  if not enabled:
+    return func(*args), []
+  current = Profiler()
+  try:
+    return func(*args), current.events
+  finally:
+    current = None
@@ -0,0 +1,58 @@
+# Signature scanner lib
+# Finds every occurrence of a set of byte patterns in a single pass over the data
+# Uses an Aho-Corasick automaton, flattened into a full transition table so that each input byte costs one lookup
+
+from collections import deque
+
+class SignatureScanner:
+  def __init__(self, patterns):
+    self.patterns = [bytes(pattern) for pattern in patterns]
+    if any(len(pattern) == 0 for pattern in self.patterns):
+      raise ValueError('Signature patterns can\'t be empty')
+    self.build()
+
+  def build(self):
+    # build a trie of all the patterns
+    goto = [{}]
+    matches = [[]]
+    for index, pattern in enumerate(self.patterns):
+      state = 0
+      for byte in pattern:
+        next_state = goto[state].get(byte)
+        if next_state is None:
+          next_state = len(goto)
+          goto[state][byte] = next_state
+          goto.append({})
+          matches.append([])
+        state = next_state
+      matches[state].append(index)
+
+    # walk the trie breadth-first to fill in failure transitions
+    # each state's row starts as a copy of its failure state's row, so every byte has a transition
+    fail = [0] * len(goto)
+    table = [None] * len(goto)
+    table[0] = [goto[0].get(byte, 0) for byte in range(256)]
+    queue = deque(goto[0].values())
+    while queue:
+      state = queue.popleft()
+      row = list(table[fail[state]])
+      for byte, next_state in goto[state].items():
+        fail[next_state] = table[fail[state]][byte]
+        matches[next_state] += matches[fail[next_state]]
+        row[byte] = next_state
+        queue.append(next_state)
+      table[state] = row
+    self.table = table
+    self.matches = [tuple(match) if match else None for match in matches]
+
+  def scan(self, data):
+    # Yields a (pattern index, offset) pair for every match, in the order they end
+    table = self.table
+    matches = self.matches
+    patterns = self.patterns
+    state = 0
+    for pos, byte in enumerate(data):
+      state = table[state][byte]
+      if matches[state] is not None:
+        for index in matches[state]:
+          yield index, pos - len(patterns[index]) + 1
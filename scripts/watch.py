@@ -0,0 +1,84 @@
+# File watcher lib
+# Blocks until any file in a set of folders changes
+# Uses filesystem change notifications from the watchdog package if it's installed, otherwise polls file stats
+
+import os
+import threading
+import time
+
+try:
+  from watchdog.events import FileSystemEventHandler
+  from watchdog.observers import Observer
+except ImportError:
+  Observer = None
+
+def snapshot(paths):
+  # Returns {path: (mtime, size)} for every file under the given folders
+  result = {}
+  stack = [str(path) for path in paths]
+  while stack:
+    try:
+      entries = list(os.scandir(stack.pop()))
+    except OSError:
+      continue
+    for entry in entries:
+      if entry.is_dir():
+        stack.append(entry.path)
+      else:
+        try:
+          stat = entry.stat()
+        except OSError:
+          continue
+        result[entry.path] = (stat.st_mtime_ns, stat.st_size)
+  return result
+
+if Observer is not None:
+  class ChangeHandler(FileSystemEventHandler):
+    def __init__(self, event):
+      self.event = event
+
+    def on_any_event(self, event):
+      self.event.set()
+
+class ChangeWatcher:
+  def __init__(self, paths, poll_interval=0.05, settle_time=0.01):
+    self.paths = [str(path) for path in paths if os.path.isdir(str(path))]
+    self.poll_interval = poll_interval
+    # editors often write a file in several steps, so wait for this long after the first event before reporting it
+    self.settle_time = settle_time
+    self.state = snapshot(self.paths)
+    self.observer = None
+    self.event = threading.Event()
+    if Observer is not None:
+      self.observer = Observer()
+      handler = ChangeHandler(self.event)
+      for path in self.paths:
+        self.observer.schedule(handler, path, recursive=True)
+      self.observer.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self.observer is not None:
+      self.observer.stop()
+      self.observer.join()
+      self.observer = None
+
+  def wait(self):
+    # Returns the set of paths that were added, removed or modified since the last call
+    while True:
+      if self.observer is not None:
+        self.event.wait()
+        time.sleep(self.settle_time)
+        self.event.clear()
+      else:
+        time.sleep(self.poll_interval)
+      state = snapshot(self.paths)
+      changed = set(path for path in state.keys() | self.state.keys() if state.get(path) != self.state.get(path))
+      self.state = state
+      if changed:
+        return changed
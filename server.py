@@ -0,0 +1,172 @@
+# Patch generation service
+# Serves personalized luma patches over HTTP, without running the full build for every request
+# The romfs files are built once at startup, and each region's code.ips is precompiled as a template
+# with fixed holes for the gallery URL and certs, so a request only has to fill those in and zip the result
+# Usage: server.py [--host HOST] [--port PORT]
+# GET /patch.zip?url=<gallery url>&tenant=<name>&region=EUR,USA
+
+import argparse
+import io
+import os
+import pathlib
+import struct
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import scripts.ips as Ips
+from build import REGIONS, build_romfs, get_tenant_setup_config, get_tenants, load_config, load_setup, open_cache
+
+class CodebinTemplate:
+  # A code.ips with a fixed record layout, so that a new patch only needs the URL and certs copied into it
+  # Unlike build_codebin, records aren't optimized, since the layout can't depend on the data that goes in them
+  def __init__(self, setup, region_config):
+    self.setup = setup
+    records = [
+      ('CERT_A_SIZE', int(region_config['CERT_A_SIZE']), bytes(4)),
+      ('CERT_B_SIZE', int(region_config['CERT_B_SIZE']), bytes(4)),
+      # Null out the ARM branch-if-equal operation that jumps into the NASC check
+      ('NASC_BRANCH', int(region_config['NASC_BRANCH']), bytes(4)),
+      ('CERT_A_DATA', int(region_config['CERT_A_DATA']), bytes(setup['CERT_A_SIZE_MAX'])),
+      ('CERT_B_DATA', int(region_config['CERT_B_DATA']), bytes(setup['CERT_B_SIZE_MAX'])),
+      ('GALLERY_URL', int(region_config['GALLERY_URL']), bytes(setup['GALLERY_URL_SIZE_MAX'])),
+    ]
+    patch = Ips.IpsPatch()
+    # track where each record's data ends up in the patch file
+    self.holes = {}
+    pos = 5
+    for name, offset, data in records:
+      patch.add_record(offset, data, rle=False)
+      self.holes[name] = pos + Ips.IPS_RECORD_SIZE
+      pos += Ips.IPS_RECORD_SIZE + len(data)
+    self.data = patch.write()
+
+  def fill(self, gallery_url, cert_a_data, cert_b_data):
+    setup = self.setup
+    gallery_url = gallery_url.encode('ascii')
+    if len(gallery_url) > setup['GALLERY_URL_SIZE_MAX']:
+      raise ValueError('Gallery URL cannot exceed %d characters' % setup['GALLERY_URL_SIZE_MAX'])
+    if len(cert_a_data) > setup['CERT_A_SIZE_MAX']:
+      raise ValueError('Maximum filesize for cert A is %d bytes' % setup['CERT_A_SIZE_MAX'])
+    if len(cert_b_data) > setup['CERT_B_SIZE_MAX']:
+      raise ValueError('Maximum filesize for cert B is %d bytes' % setup['CERT_B_SIZE_MAX'])
+    # the template's holes are already zeroed, so whatever isn't filled in stays nulled out
+    result = bytearray(self.data)
+    for name, data in [
+      ('CERT_A_SIZE', struct.pack('<I', len(cert_a_data))),
+      ('CERT_B_SIZE', struct.pack('<I', len(cert_b_data))),
+      ('CERT_A_DATA', cert_a_data),
+      ('CERT_B_DATA', cert_b_data),
+      ('GALLERY_URL', gallery_url),
+    ]:
+      hole = self.holes[name]
+      result[hole:hole + len(data)] = data
+    return bytes(result)
+
+class PatchService:
+  def __init__(self, config):
+    self.config = config
+    # the default [SETUP] is keyed by an empty tenant name
+    self.setups = {'': load_setup(config['SETUP'])}
+    for tenant in get_tenants(config):
+      self.setups[tenant] = load_setup(get_tenant_setup_config(config, tenant))
+    self.templates = {}
+    self.romfs = {}
+    for region in REGIONS:
+      region_config = config[region]
+      for tenant, setup in self.setups.items():
+        self.templates[(region, tenant)] = CodebinTemplate(setup, region_config)
+      self.romfs[region] = self.load_romfs(pathlib.Path('./luma/titles/%s' % region_config['TITLE_ID']))
+
+  def load_romfs(self, title_path):
+    # Keep the prebuilt romfs files in memory, as (zip path, data) pairs
+    files = []
+    romfs_path = title_path / 'romfs'
+    if romfs_path.exists():
+      for path in sorted(romfs_path.rglob('*')):
+        if path.is_file():
+          files.append(('luma/titles/%s/%s' % (title_path.name, path.relative_to(title_path).as_posix()), path.read_bytes()))
+    return files
+
+  def make_patch_zip(self, regions, tenant='', gallery_url=None):
+    if tenant not in self.setups:
+      raise ValueError('Unknown tenant %s' % tenant)
+    setup = self.setups[tenant]
+    if gallery_url is None:
+      gallery_url = setup['GALLERY_URL']
+    result = io.BytesIO()
+    # romfs archives are already compressed or tiny, so everything is stored as-is
+    with zipfile.ZipFile(result, 'w', zipfile.ZIP_STORED) as zip_file:
+      for region in regions:
+        if region not in REGIONS:
+          raise ValueError('Unknown region %s' % region)
+        codebin = self.templates[(region, tenant)].fill(gallery_url, setup['CERT_A'], setup['CERT_B'])
+        zip_file.writestr('luma/titles/%s/code.ips' % self.config[region]['TITLE_ID'], codebin)
+        for path, data in self.romfs[region]:
+          zip_file.writestr(path, data)
+    return result.getvalue()
+
+class PatchRequestHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    request = urlparse(self.path)
+    if request.path == '/health':
+      self.send_body(200, b'ok', 'text/plain')
+      return
+    if request.path != '/patch.zip':
+      self.send_body(404, b'Not found', 'text/plain')
+      return
+    query = parse_qs(request.query)
+    regions = query['region'][0].split(',') if 'region' in query else REGIONS
+    tenant = query['tenant'][0] if 'tenant' in query else ''
+    gallery_url = query['url'][0] if 'url' in query else None
+    try:
+      body = self.server.service.make_patch_zip(regions, tenant, gallery_url)
+    except (ValueError, UnicodeEncodeError) as error:
+      self.send_body(400, str(error).encode('utf-8'), 'text/plain')
+      return
+    self.send_body(200, body, 'application/zip', {'Content-Disposition': 'attachment; filename="luma.zip"'})
+
+  def send_body(self, status, body, content_type, headers={}):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if not self.server.quiet:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class PatchServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, service, quiet=False):
+    HTTPServer.__init__(self, address, PatchRequestHandler)
+    self.service = service
+    self.quiet = quiet
+
+def main():
+  parser = argparse.ArgumentParser(description='Serve personalized Flipnote Studio 3D patches over HTTP')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='number of archives to build in parallel at startup, 0 uses every core')
+  parser.add_argument('--quiet', action='store_true', help='don\'t log every request')
+  args = parser.parse_args()
+
+  config = load_config('config.ini')
+  # Make sure the romfs files are up to date before loading them
+  build_romfs(config, open_cache(), args.jobs if args.jobs > 0 else (os.cpu_count() or 1))
+  service = PatchService(config)
+  server = PatchServer((args.host, args.port), service, args.quiet)
+  print('Serving patches on http://%s:%d/patch.zip' % (args.host, args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,232 @@
+# Parity checker for built romfs archives
+# Compares archives with the retail ones byte for byte, decompressing BLZ archives where needed
+# Whole archives are hashed first, then the entries of any that differ, and only the entries that differ get parsed
+# Differences are reported with the first differing section (DARC header, entry table or label block, MSBT LBL1/ATR1/TXT2) and byte offset
+# Usage: verify.py <retail romfs dir> <built romfs dir> [<retail romfs dir> <built romfs dir>...] [-j N] [--strict]
+#        verify.py --roundtrip <retail romfs dir> [<retail romfs dir>...] [-j N] [--strict]
+# The first form checks every archive in a built romfs folder (e.g. luma/titles/<TITLE_ID>/romfs) against the same path in the retail romfs
+# --roundtrip extracts every retail archive like extract_darc.py does, rebuilds it like build.py does, and checks that the result is the same archive
+# Archives whose DARC data matches but whose BLZ compressed data doesn't are only counted as differing with --strict
+# Exits with status 1 if any archive differs
+
+import scripts.blz as Blz
+from scripts.darc import Darc, is_darc
+
+import argparse
+import hashlib
+import os
+import struct
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from build import compile_archive
+from extract_darc import extract_darc, find_archives
+
+IDENTICAL = 'identical'
+# The decompressed DARC data is identical, only the compression differs
+SAME_CONTENT = 'same content'
+DIFFERS = 'differs'
+MISSING = 'missing'
+# Errors raised when decompressing or parsing a corrupt archive
+ARCHIVE_ERRORS = (Blz.BlzError, ValueError, struct.error)
+
+def hash_data(data):
+  return hashlib.sha1(data).digest()
+
+def is_same(a, b):
+  return len(a) == len(b) and hash_data(a) == hash_data(b)
+
+def first_difference(a, b, block_size=0x1000):
+  # Returns the offset of the first byte that differs, or None if both are the same
+  # Compares a block at a time, and only compares bytes one by one within the first block that differs
+  size = min(len(a), len(b))
+  for start in range(0, size, block_size):
+    end = min(start + block_size, size)
+    if a[start:end] != b[start:end]:
+      for i in range(start, end):
+        if a[i] != b[i]:
+          return i
+  return size if len(a) != len(b) else None
+
+def unpack_archive(data):
+  # Returns the archive's DARC data, and whether it was compressed
+  if is_darc(data):
+    return data, False
+  return Blz.decompress(data), True
+
+def describe_darc_offset(darc, data, offset):
+  endian = '<' if data[4:6] == b'\xff\xfe' else '>'
+  table_offset, table_size, data_offset = struct.unpack_from('%s3I'%endian, data, 16)
+  num_nodes = struct.unpack_from('%sI'%endian, data, table_offset + 8)[0]
+  if offset < 28:
+    return 'DARC header'
+  if offset < table_offset + num_nodes * 12:
+    # the first two nodes are the root folder and its '.' label, then one node for each entry in the same order as the entries
+    node = (offset - table_offset) // 12
+    names = list(darc.index)
+    return 'DARC entry table, node %d%s' % (node, ' (%s)' % names[node - 2] if 2 <= node < len(names) + 2 else '')
+  if offset < table_offset + table_size:
+    return 'DARC label block'
+  for name, (start, size) in sorted(darc.index.items(), key=lambda item: item[1][0]):
+    if offset < start:
+      return 'padding before %s' % name
+    if offset < start + size:
+      return 'entry %s' % name
+  return 'end of archive'
+
+def describe_msbt_offset(data, offset):
+  if offset < 32 or len(data) < 32:
+    return 'MSBT header'
+  endian = '<' if data[8:10] == b'\xff\xfe' else '>'
+  num_sections = struct.unpack_from('%sH'%endian, data, 14)[0]
+  section_offset = 32
+  for i in range(num_sections):
+    if section_offset + 16 > len(data):
+      break
+    magic, size = struct.unpack_from('%s4sI'%endian, data, section_offset)
+    name = magic.decode('ascii', 'replace')
+    end = section_offset + 16 + size + (-size % 0x10)
+    if offset < section_offset + 16:
+      return '%s section header' % name
+    if offset < end:
+      pos = offset - section_offset - 16
+      return '%s section%s' % (name, describe_msbt_section_offset(magic, data, section_offset + 16, size, pos, endian))
+    section_offset = end
+  return 'end of MSBT'
+
+def describe_msbt_section_offset(magic, data, offset, size, pos, endian):
+  # Narrows a difference down to a label group or string where possible
+  count = struct.unpack_from('%sI'%endian, data, offset)[0]
+  if pos < 4:
+    return ' count'
+  if magic == b'LBL1':
+    if pos < 4 + count * 8:
+      return ', group table, group %d' % ((pos - 4) // 8)
+    return ', labels'
+  if magic == b'TXT2':
+    if pos < 4 + count * 4:
+      return ', string offset table, string %d' % ((pos - 4) // 4)
+    offsets = struct.unpack_from('%s%dI'%(endian, count), data, offset + 4) + (size,)
+    for i in range(count):
+      if offsets[i] <= pos < offsets[i + 1]:
+        return ', string %d' % i
+    return ', padding'
+  return ''
+
+def describe_entry_difference(name, retail_data, built_data, entry_offset):
+  offset = first_difference(retail_data, built_data)
+  where = describe_msbt_offset(retail_data, offset) if name.endswith('.msbt') else 'data'
+  sizes = '' if len(retail_data) == len(built_data) else ', size 0x%X -> 0x%X' % (len(retail_data), len(built_data))
+  return '%s: %s at entry offset 0x%X (archive offset 0x%X)%s' % (name, where, offset, entry_offset + offset, sizes)
+
+def compare_darcs(retail_data, built_data):
+  retail = Darc.from_bytes(retail_data)
+  built = Darc.from_bytes(built_data)
+  try:
+    offset = first_difference(retail_data, built_data)
+    details = ['first difference at 0x%X, in %s' % (offset, describe_darc_offset(retail, retail_data, offset))]
+    retail_entries = {entry.name: entry.data for entry in retail.root.entries}
+    built_entries = {entry.name: entry.data for entry in built.root.entries}
+    for name in sorted(retail_entries.keys() - built_entries.keys()):
+      details.append('%s: missing from the built archive' % name)
+    for name in sorted(built_entries.keys() - retail_entries.keys()):
+      details.append('%s: not in the retail archive' % name)
+    # Entries are hashed first, so only the ones that differ are compared byte by byte
+    for name in sorted(retail_entries.keys() & built_entries.keys()):
+      if not is_same(retail_entries[name], built_entries[name]):
+        details.append(describe_entry_difference(name, retail_entries[name], built_entries[name], retail.index[name][0]))
+    return details
+  finally:
+    retail.close()
+    built.close()
+
+def compare_archives(retail, built):
+  # Returns (status, [detail lines])
+  if is_same(retail, built):
+    return IDENTICAL, []
+  retail_darc, retail_compressed = unpack_archive(retail)
+  built_darc, built_compressed = unpack_archive(built)
+  details = []
+  if retail_compressed != built_compressed:
+    details.append('the retail archive is %scompressed, the built one is %scompressed' % ('' if retail_compressed else 'not ', '' if built_compressed else 'not '))
+  if is_same(retail_darc, built_darc):
+    return SAME_CONTENT, details + ['compressed data differs at 0x%X' % first_difference(retail, built)]
+  return DIFFERS, details + compare_darcs(retail_darc, built_darc)
+
+def verify_archive(retail_path, built_path):
+  if not retail_path.exists():
+    return MISSING, ['no retail archive at %s' % retail_path]
+  try:
+    return compare_archives(retail_path.read_bytes(), built_path.read_bytes())
+  # A corrupt or truncated archive is a difference too, and shouldn't stop the other archives from being checked
+  except ARCHIVE_ERRORS as error:
+    return DIFFERS, ['could not be read: %s' % describe_error(error)]
+
+def roundtrip_archive(retail_path):
+  # Rebuilds the archive from its extracted sources, then compares it with the original
+  try:
+    retail = retail_path.read_bytes()
+    data, compressed = unpack_archive(retail)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      src_path = Path(tmp_dir) / retail_path.name
+      with Darc.from_bytes(data) as darc:
+        extract_darc(darc, src_path)
+      built = compile_archive(src_path, compressed)
+    return compare_archives(retail, built)
+  except ARCHIVE_ERRORS + (KeyError, IndexError) as error:
+    return DIFFERS, ['could not be rebuilt: %s' % describe_error(error)]
+
+def describe_error(error):
+  return '%s: %s' % (type(error).__name__, error) if str(error) else type(error).__name__
+
+def main():
+  parser = argparse.ArgumentParser(description='Check built romfs archives against retail ones, byte for byte')
+  parser.add_argument('paths', nargs='+', help='pairs of <retail romfs dir> <built romfs dir>, or retail romfs dirs with --roundtrip')
+  parser.add_argument('--roundtrip', action='store_true', help='extract and rebuild every retail archive, and check the result against the original')
+  parser.add_argument('--strict', action='store_true', help='also fail archives that only differ in their BLZ compressed data')
+  parser.add_argument('-j', '--jobs', type=int, default=0, help='number of archives to check in parallel, 0 uses every core')
+  args = parser.parse_args()
+  jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+
+  start = time.perf_counter()
+  if args.roundtrip:
+    archives = []
+    for romfs_path in args.paths:
+      find_archives(Path(romfs_path), Path(romfs_path), archives)
+    names = [retail_path for retail_path, output_path in archives]
+    func, func_args = roundtrip_archive, [names]
+  else:
+    if len(args.paths) % 2:
+      parser.error('a <retail romfs dir> <built romfs dir> pair is needed for each romfs folder')
+    archives = []
+    # Only archives that were built are checked, since the build output only contains the archives that were patched
+    for i in range(0, len(args.paths), 2):
+      find_archives(Path(args.paths[i + 1]), Path(args.paths[i]), archives)
+    names = [built_path for built_path, retail_path in archives]
+    func, func_args = verify_archive, [[retail_path for built_path, retail_path in archives], names]
+  if not names:
+    exit('No archives found')
+
+  if jobs == 1 or len(names) < 2:
+    results = list(map(func, *func_args))
+  else:
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+      results = list(executor.map(func, *func_args))
+
+  failed = 0
+  counts = {IDENTICAL: 0, SAME_CONTENT: 0, DIFFERS: 0, MISSING: 0}
+  for name, (status, details) in zip(names, results):
+    counts[status] += 1
+    if status in (DIFFERS, MISSING) or (status == SAME_CONTENT and args.strict):
+      failed += 1
+    print('%-12s %s' % (status, name))
+    for line in details:
+      print('  %s' % line)
+  print('Checked %d archives in %d ms: %d identical, %d same content, %d differ, %d missing' % (len(names), (time.perf_counter() - start) * 1000, counts[IDENTICAL], counts[SAME_CONTENT], counts[DIFFERS], counts[MISSING]))
+  if failed:
+    exit(1)
+
+if __name__ == '__main__':
+  main()